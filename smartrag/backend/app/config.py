@@ -29,12 +29,20 @@ class Settings(BaseSettings):
     redis_port: int = 6379
     redis_password: Optional[str] = ""  # 从环境变量读取
     redis_db: int = 0
+    # 连接池最大连接数（环境变量 REDIS_POOL_SIZE）
+    redis_pool_size: int = 50
     
     # 邮件配置
     mail_count: str = ""  # 从环境变量读取
     mail_password: str = ""  # 从环境变量读取
     mail_server: str = ""  # 从环境变量读取
     mail_port: int = 465
+    # 并行发送邮件的工作线程数（每个线程各自使用一个 SMTP 连接）
+    mail_workers: int = 4
+    # 启动时预先建立的 SMTP 连接数
+    mail_prewarm: int = 2
+    # 异步发送队列的最大长度，队列已满时拒绝新的发送请求
+    mail_queue_max: int = 10000
     
     # JWT配置
     secret_key: str = ""  # 从环境变量读取
@@ -54,11 +62,29 @@ class Settings(BaseSettings):
     siliconflow_base_url: str = "https://api.siliconflow.cn/v1"
     siliconflow_model: str = "THUDM/GLM-4-9B-0414"
     
+    # 非流式回复的进程内 LRU 缓存（相同模型与消息时直接复用回复）
+    enable_cache: bool = False
+    llm_cache_max_entries: int = 4096
+    # 同时进行中的 LLM 调用上限
+    llm_max_concurrency: int = 32
+    # 发送给 LLM 的上下文估算 token 上限（超出时丢弃最早的历史消息）
+    llm_context_token_budget: int = 6000
+    # 生成摘要时输入对话内容的估算 token 上限（超出时丢弃最早的消息）
+    summary_input_token_budget: int = 3000
+    # 语义回复缓存：语义近似的问题直接复用回复（会改变回复语义，默认关闭）
+    semantic_cache_enabled: bool = False
+    semantic_cache_threshold: float = 0.95
+    semantic_cache_max_entries: int = 10000
+    embedding_model: str = "BAAI/bge-m3"
+    
     # MinIO配置
     minio_endpoint: str = ""
     minio_access_key: str = ""
     minio_secret_key: str = ""
     minio_bucket: str = "upload"
+    # 分片上传：分片大小（字节，0 表示按文件大小自动选择）与并行分片数
+    minio_part_size: int = 0
+    minio_parallel_uploads: int = 4
     
     # 文件存储路径
     file_storage_path: str = "/home/seven/work/talor/rag/file_databases"
@@ -9,7 +9,7 @@ from app.schemas.auth import (
     SendVerificationCodeRequest, VerifyCodeRequest, SendResetCodeRequest,
     ResetPasswordRequest
 )
-from app.services.auth_service import AuthService
+from app.services.auth_service import auth_service
 from app.utils.redis_client import redis_client
 from app.utils.email_service import email_service
 
@@ -22,8 +22,6 @@ async def send_verification_code(
     db: Session = Depends(get_db)
 ):
     """发送验证码"""
-    auth_service = AuthService(db)
-    
     # 检查邮箱是否已被注册
     existing_user = db.query(User).filter(User.email == request.email).first()
     
@@ -33,7 +31,7 @@ async def send_verification_code(
             detail="邮箱已被注册"
         )
     
-    code = auth_service.send_verification_code(request.email)
+    code = await auth_service.send_verification_code(request.email)
     return {"success": True, "message": "验证码已发送", "email": request.email}
 
 
@@ -43,8 +41,6 @@ async def verify_code(
     db: Session = Depends(get_db)
 ):
     """验证验证码"""
-    auth_service = AuthService(db)
-    
     if auth_service.verify_code(request.email, request.code, request.code_type):
         return {"message": "验证码正确", "valid": True}
     else:
@@ -60,7 +56,6 @@ async def verify_code_details(
     db: Session = Depends(get_db)
 ):
     """验证验证码并返回详细信息"""
-    auth_service = AuthService(db)
     result = auth_service.verify_code_with_details(request.email, request.code, request.code_type)
     
     if result["valid"]:
@@ -78,8 +73,7 @@ async def register(
     db: Session = Depends(get_db)
 ):
     """用户注册"""
-    auth_service = AuthService(db)
-    user = auth_service.register_user(user_data)
+    user = await auth_service.register_user(db, user_data)
     return {
         "success": True,
         "message": "注册成功",
@@ -101,8 +95,7 @@ async def login(
     db: Session = Depends(get_db)
 ):
     """用户登录"""
-    auth_service = AuthService(db)
-    return auth_service.login_user(login_data.email, login_data.password)
+    return await auth_service.login_user(db, login_data.email, login_data.password)
 
 
 @router.post("/refresh", response_model=Token)
@@ -111,8 +104,7 @@ async def refresh_token(
     db: Session = Depends(get_db)
 ):
     """刷新访问令牌"""
-    auth_service = AuthService(db)
-    return auth_service.refresh_token(refresh_data.refresh_token)
+    return auth_service.refresh_token(db, refresh_data.refresh_token)
 
 
 @router.post("/send-reset-code", status_code=status.HTTP_200_OK)
@@ -121,10 +113,8 @@ async def send_reset_code(
     db: Session = Depends(get_db)
 ):
     """发送密码重置验证码"""
-    auth_service = AuthService(db)
-    
     try:
-        code = auth_service.send_password_reset_code(request.email)
+        code = await auth_service.send_password_reset_code(db, request.email)
         # 无论邮箱是否存在都返回相同的成功响应
         return {"success": True, "message": "如果该邮箱已注册，重置验证码将发送到您的邮箱", "email": request.email}
     except HTTPException as e:
@@ -143,10 +133,8 @@ async def reset_password(
     db: Session = Depends(get_db)
 ):
     """重置密码"""
-    auth_service = AuthService(db)
-    
     try:
-        success = auth_service.reset_password(request.email, request.code, request.new_password)
+        success = await auth_service.reset_password(db, request.email, request.code, request.new_password)
         if success:
             return {"success": True, "message": "密码重置成功"}
         else:
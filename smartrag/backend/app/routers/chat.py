@@ -6,7 +6,7 @@ import json
 import asyncio
 from app.dependencies import get_db, get_current_user
 from app.schemas.chat import ChatRequest, ChatResponse, ChatMessage, SimpleMessageRequest
-from app.services.chat_service import chat_service
+from app.services.chat_service import ChatService, get_chat_service
 from app.utils.logger import logger
 from app.models.user import User
 from app.models.role import Role
@@ -57,7 +57,8 @@ def get_knowledge_name_by_role(user: User, db: Session) -> str:
 @router.post("/send", response_model=ChatResponse)
 async def send_message(
     request: ChatRequest,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    chat_service: ChatService = Depends(get_chat_service)
 ):
     """
     发送聊天消息并获取回复
@@ -89,7 +90,8 @@ async def send_message(
 async def process_message(
     request: SimpleMessageRequest,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    chat_service: ChatService = Depends(get_chat_service)
 ):
     """
     处理简单的文本消息并返回回复文本
@@ -137,7 +139,8 @@ async def chat_health_check():
 async def stream_message(
     request: SimpleMessageRequest,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    chat_service: ChatService = Depends(get_chat_service)
 ):
     """
     流式处理聊天消息并返回回复
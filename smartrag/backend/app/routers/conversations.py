@@ -208,7 +208,7 @@ async def delete_conversation(
         conversation_service.delete_conversation(conversation_id)
         
         # 清空Redis中的会话数据
-        await user_session_manager.clear_session(current_user.id)
+        await user_session_manager.clear_session(conversation_id)
         
         logger.info(f"用户 {current_user.id} 删除会话: {conversation_id}")
         
@@ -1,22 +1,8 @@
+from dataclasses import dataclass
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List
 from datetime import datetime
-
-
-class RoleBase(BaseModel):
-    role_code: str
-    role_name: str
-    description: Optional[str] = None
-
-
-class RoleResponse(RoleBase):
-    id: int
-    is_active: bool
-    created_at: datetime
-    updated_at: datetime
-    
-    class Config:
-        from_attributes = True
+from app.schemas.role import RoleResponse
 
 
 class UserBase(BaseModel):
@@ -48,7 +34,9 @@ class Token(BaseModel):
     refresh_token: str
 
 
-class TokenData(BaseModel):
+@dataclass(slots=True, frozen=True)
+class TokenData:
+    """令牌内部数据（非接口模型，使用轻量数据类）"""
     email: Optional[str] = None
 
 
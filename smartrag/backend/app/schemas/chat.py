@@ -1,9 +1,12 @@
+from dataclasses import dataclass
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
 
 
-class ChatMessage(BaseModel):
+@dataclass(slots=True, frozen=True)
+class ChatMessage:
+    """内部聊天消息（非接口模型，使用轻量数据类）"""
     id: str
     role: str  # 'user' or 'model'
     text: str
@@ -1,7 +1,12 @@
+import asyncio
 import random
 import string
 import threading
-from typing import Dict
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+from pydantic import TypeAdapter
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 from fastapi import HTTPException, status
 from app.utils.logger import logger
@@ -15,26 +20,38 @@ from app.utils.security import (
     verify_token
 )
 from app.utils.redis_client import redis_client
-from app.utils.email_service import email_service
+from app.utils.email_service import email_service, MailQueueFullError
+
+
+# 模块级缓存的校验器，避免每次注册重复构建
+_USER_RESPONSE_ADAPTER = TypeAdapter(UserResponse)
+
+# 用户锁的分片数（2 的幂）
+_USER_LOCK_SHARDS = 256
+
+# 邮件发送队列已满时建议客户端等待的秒数
+_MAIL_RETRY_AFTER_SECONDS = 30
+
+
+def _mail_queue_full_error() -> HTTPException:
+    """邮件发送队列已满时返回的 503 错误，附带 Retry-After"""
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="邮件发送繁忙，请稍后重试",
+        headers={"Retry-After": str(_MAIL_RETRY_AFTER_SECONDS)}
+    )
 
 
 class AuthService:
-    def __init__(self, db: Session):
-        self.db = db
-        
-        # 检查是否使用Redis
-        self.use_redis = redis_client.redis_client is not None
-        
-        # 用户级别的锁，防止同一用户的并发操作
-        self._locks: Dict[str, threading.Lock] = {}
-        self._lock_lock = threading.Lock()
+    """认证服务，进程内单例，数据库会话按调用传入"""
+    
+    def __init__(self):
+        # 按邮箱分片的用户锁，防止同一用户的并发操作；分片数固定，内存占用不随用户数增长
+        self._lock_shards: List[threading.Lock] = [threading.Lock() for _ in range(_USER_LOCK_SHARDS)]
     
     def _get_user_lock(self, email: str) -> threading.Lock:
-        """获取指定用户的锁"""
-        with self._lock_lock:
-            if email not in self._locks:
-                self._locks[email] = threading.Lock()
-            return self._locks[email]
+        """获取指定用户所在分片的锁"""
+        return self._lock_shards[hash(email) & (_USER_LOCK_SHARDS - 1)]
 
     def generate_verification_code(self, length: int = 6) -> str:
         """生成随机验证码"""
@@ -75,8 +92,12 @@ class AuthService:
             "errors": errors
         }
 
-    def send_verification_code(self, email: str) -> str:
-        """发送验证码，支持多用户场景"""
+    async def send_verification_code(self, email: str) -> str:
+        """发送验证码，支持多用户场景（阻塞的存储操作在线程池中执行，不占用事件循环）"""
+        return await asyncio.to_thread(self._send_verification_code_sync, email)
+    
+    def _send_verification_code_sync(self, email: str) -> str:
+        """发送验证码的同步实现"""
         # 获取用户锁，防止同一用户的并发验证码请求
         lock = self._get_user_lock(email)
         with lock:
@@ -85,7 +106,13 @@ class AuthService:
             # 存储验证码到Redis，标记为注册类型
             if redis_client.set_verification_code(email, code, "registration"):
                 # 使用飞书邮件服务发送验证码（异步发送）
-                if email_service.send_verification_code(email, code, async_send=True):
+                try:
+                    sent = email_service.send_verification_code(email, code, async_send=True)
+                except MailQueueFullError:
+                    # 发送队列已满，删除验证码并提示客户端稍后重试
+                    redis_client.delete_verification_code(email, "registration")
+                    raise _mail_queue_full_error()
+                if sent:
                     logger.info(f"验证码已发送: {email}")
                     return code
                 else:
@@ -111,8 +138,12 @@ class AuthService:
         """验证验证码并返回详细信息"""
         return redis_client.verify_code_with_details(email, code, code_type)
 
-    def register_user(self, user_data: UserCreate) -> UserResponse:
-        """用户注册，支持多用户场景"""
+    async def register_user(self, db: Session, user_data: UserCreate) -> UserResponse:
+        """用户注册（密码哈希和数据库操作在线程池中执行，不占用事件循环）"""
+        return await asyncio.to_thread(self._register_user_sync, db, user_data)
+    
+    def _register_user_sync(self, db: Session, user_data: UserCreate) -> UserResponse:
+        """用户注册的同步实现，支持多用户场景"""
         # 获取用户锁，防止同一用户的并发注册
         lock = self._get_user_lock(user_data.email)
         with lock:
@@ -134,54 +165,67 @@ class AuthService:
                     detail=verification_result
                 )
             
-            # 检查用户名是否已存在
-            existing_user = self.db.query(User).filter(User.username == user_data.username).first()
-            if existing_user:
-                logger.warning(f"注册用户名已存在: {user_data.username}")
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="用户名已存在"
-                )
-            
-            # 检查邮箱是否已存在
-            existing_email = self.db.query(User).filter(User.email == user_data.email).first()
-            if existing_email:
+            # 一次查询同时检查用户名和邮箱是否已存在
+            collision = db.query(User.username, User.email).filter(
+                or_(User.username == user_data.username, User.email == user_data.email)
+            ).first()
+            if collision:
+                if collision.username == user_data.username:
+                    logger.warning(f"注册用户名已存在: {user_data.username}")
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail="用户名已存在"
+                    )
                 logger.warning(f"注册邮箱已存在: {user_data.email}")
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="邮箱已被注册"
                 )
             
-            # 创建新用户
+            # 创建新用户，默认值在应用侧给出，提交后无需再回查
             hashed_password = get_password_hash(user_data.password)
+            created_at = datetime.now()
             db_user = User(
                 username=user_data.username,
                 email=user_data.email,
                 hashed_password=hashed_password,
-                role_ids=user_data.role_ids  # 使用传入的角色ID列表
+                role_ids=user_data.role_ids,  # 使用传入的角色ID列表
+                is_active=True,
+                created_at=created_at
             )
             
             try:
-                self.db.add(db_user)
-                self.db.commit()
-                self.db.refresh(db_user)
+                db.add(db_user)
+                db.flush()  # 获取自增ID
+                user_id = db_user.id
+                db.commit()
                 
                 # 注册成功后删除验证码
                 redis_client.delete_verification_code(user_data.email, "registration")
                 
                 logger.info(f"用户注册成功: {user_data.email[:3]}***")
-                return UserResponse.model_validate(db_user)
+                # 使用已知的值构建响应，新注册用户没有角色详情
+                return _USER_RESPONSE_ADAPTER.validate_python({
+                    "id": user_id,
+                    "username": user_data.username,
+                    "email": user_data.email,
+                    "is_active": True,
+                    "created_at": created_at,
+                    "last_login": None,
+                    "role_ids": user_data.role_ids,
+                    "roles": None
+                })
             except Exception as e:
-                self.db.rollback()
+                db.rollback()
                 logger.error(f"用户注册失败: {user_data.email}, 错误: {e}")
                 raise HTTPException(
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                     detail="注册失败，请稍后重试"
                 )
 
-    def authenticate_user(self, email: str, password: str) -> User:
+    def authenticate_user(self, db: Session, email: str, password: str) -> User:
         """用户认证"""
-        user = self.db.query(User).filter(User.email == email).first()
+        user = db.query(User).filter(User.email == email).first()
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -202,21 +246,26 @@ class AuthService:
         
         return user
     
-    def send_password_reset_code(self, email: str) -> str:
-        """发送密码重置验证码"""
+    async def send_password_reset_code(self, db: Session, email: str) -> str:
+        """发送密码重置验证码（阻塞的存储操作在线程池中执行，不占用事件循环）"""
+        code = await asyncio.to_thread(self._send_password_reset_code_sync, db, email)
+        if code is None:
+            # 为了安全，无论邮箱是否存在都返回相同的响应
+            # 使用随机延迟防止时序攻击，异步等待不阻塞其他请求
+            await asyncio.sleep(random.uniform(0.5, 1.5))
+            logger.info(f"密码重置请求: 邮箱不存在")
+            return "dummy_code"  # 返回虚拟验证码，但不会实际发送
+        return code
+    
+    def _send_password_reset_code_sync(self, db: Session, email: str) -> Optional[str]:
+        """发送密码重置验证码的同步实现，邮箱不存在时返回None"""
         # 获取用户锁，防止同一用户的并发验证码请求
         lock = self._get_user_lock(email)
         with lock:
             # 检查邮箱是否存在
-            user = self.db.query(User).filter(User.email == email).first()
+            user = db.query(User).filter(User.email == email).first()
             if not user:
-                # 为了安全，无论邮箱是否存在都返回相同的响应
-                # 使用随机延迟防止时序攻击
-                import time
-                import random
-                time.sleep(random.uniform(0.5, 1.5))
-                logger.info(f"密码重置请求: 邮箱不存在")
-                return "dummy_code"  # 返回虚拟验证码，但不会实际发送
+                return None
             
             # 检查发送次数限制
             if not self._check_password_reset_limits(email):
@@ -232,7 +281,13 @@ class AuthService:
             # 存储验证码到Redis，标记为密码重置类型
             if redis_client.set_verification_code(email, code, "password_reset"):
                 # 使用飞书邮件服务发送验证码（异步发送），传递code_type参数
-                if email_service.send_verification_code(email, code, "password_reset", async_send=True):
+                try:
+                    sent = email_service.send_verification_code(email, code, "password_reset", async_send=True)
+                except MailQueueFullError:
+                    # 发送队列已满，删除验证码并提示客户端稍后重试
+                    redis_client.delete_verification_code(email, "password_reset")
+                    raise _mail_queue_full_error()
+                if sent:
                     logger.info(f"密码重置验证码已发送: {email[:3]}***")
                     # 记录密码重置请求（使用统一的计数器）
                     self._record_password_reset_attempt(email)
@@ -252,8 +307,12 @@ class AuthService:
                     detail="验证码存储失败，请稍后重试"
                 )
     
-    def reset_password(self, email: str, code: str, new_password: str) -> bool:
-        """验证验证码并重置密码"""
+    async def reset_password(self, db: Session, email: str, code: str, new_password: str) -> bool:
+        """验证验证码并重置密码（密码哈希和数据库操作在线程池中执行，不占用事件循环）"""
+        return await asyncio.to_thread(self._reset_password_sync, db, email, code, new_password)
+    
+    def _reset_password_sync(self, db: Session, email: str, code: str, new_password: str) -> bool:
+        """验证验证码并重置密码的同步实现"""
         # 获取用户锁，防止同一用户的并发操作
         lock = self._get_user_lock(email)
         with lock:
@@ -276,7 +335,7 @@ class AuthService:
                 )
             
             # 获取用户
-            user = self.db.query(User).filter(User.email == email).first()
+            user = db.query(User).filter(User.email == email).first()
             if not user:
                 logger.error(f"密码重置时用户不存在: {email[:3]}***")
                 raise HTTPException(
@@ -288,8 +347,8 @@ class AuthService:
             user.hashed_password = get_password_hash(new_password)
             
             try:
-                self.db.commit()
-                self.db.refresh(user)
+                db.commit()
+                db.refresh(user)
                 
                 # 删除验证码
                 redis_client.delete_verification_code(email, "password_reset")
@@ -300,7 +359,7 @@ class AuthService:
                 logger.info(f"密码重置成功: {email[:3]}***")
                 return True
             except Exception as e:
-                self.db.rollback()
+                db.rollback()
                 logger.error(f"密码重置失败: {email[:3]}***, 错误: {e}")
                 raise HTTPException(
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -314,22 +373,22 @@ class AuthService:
             today = datetime.now().strftime("%Y%m%d")
             key = f"password_reset_attempts:{email}:{today}"
             
-            if self.use_redis and redis_client.redis_client:
+            if redis_client.use_redis and redis_client.redis_client:
                 try:
-                    data = redis_client.redis_client.hgetall(key)
-                    if not data:
+                    # 同步客户端返回字节，int 可直接解析
+                    count = redis_client.redis_client.hget(key, "count")
+                    if count is None:
                         return True
                     
-                    count = int(data.get("count", 0))
                     # 检查24小时内是否超过3次
-                    return count < 3
+                    return int(count) < 3
                 except Exception as redis_error:
                     logger.error(f"Redis检查密码重置限制失败: {redis_error}")
                     return True  # Redis失败时允许通过
             else:
                 # 使用内存缓存
-                if key in redis_client.memory_cache:
-                    data = redis_client.memory_cache[key]
+                data = redis_client.memory_get(key)
+                if data:
                     count = int(data.get("count", 0))
                     return count < 3
                 return True
@@ -344,7 +403,7 @@ class AuthService:
             today = datetime.now().strftime("%Y%m%d")
             key = f"password_reset_attempts:{email}:{today}"
             
-            if self.use_redis and redis_client.redis_client:
+            if redis_client.use_redis and redis_client.redis_client:
                 try:
                     # 增加计数
                     redis_client.redis_client.hincrby(key, "count", 1)
@@ -354,41 +413,47 @@ class AuthService:
                 except Exception as redis_error:
                     logger.error(f"Redis记录密码重置尝试失败: {redis_error}")
                     # 更新内存缓存
-                    if key in redis_client.memory_cache:
-                        redis_client.memory_cache[key]["count"] += 1
+                    data = redis_client.memory_get(key)
+                    if data is not None:
+                        data["count"] += 1
                     else:
-                        redis_client.memory_cache[key] = {"count": 1}
+                        redis_client.memory_set(key, {"count": 1}, time.time() + 24 * 60 * 60)
                     return True
             else:
                 # 使用内存缓存
-                if key in redis_client.memory_cache:
-                    redis_client.memory_cache[key]["count"] += 1
+                data = redis_client.memory_get(key)
+                if data is not None:
+                    data["count"] += 1
                 else:
-                    redis_client.memory_cache[key] = {"count": 1}
+                    redis_client.memory_set(key, {"count": 1}, time.time() + 24 * 60 * 60)
                 return True
         except Exception as e:
             logger.error(f"记录密码重置尝试错误: {e}")
             return False
 
-    def login_user(self, email: str, password: str) -> dict:
-        """用户登录，支持多用户场景"""
+    async def login_user(self, db: Session, email: str, password: str) -> dict:
+        """用户登录（密码校验和数据库操作在线程池中执行，不占用事件循环）"""
+        return await asyncio.to_thread(self._login_user_sync, db, email, password)
+    
+    def _login_user_sync(self, db: Session, email: str, password: str) -> dict:
+        """用户登录的同步实现，支持多用户场景"""
         # 获取用户锁，防止同一用户的并发登录
         lock = self._get_user_lock(email)
         with lock:
-            user = self.authenticate_user(email, password)
+            user = self.authenticate_user(db, email, password)
             
             try:
                 # 更新最后登录时间
                 from datetime import datetime, timedelta
                 user.last_login = datetime.utcnow() + timedelta(hours=8)
-                self.db.commit()
+                db.commit()
                 
                 # 查询用户的角色详情
                 from app.models.role import Role
                 roles = []
                 if user.role_ids:
                     role_ids = user.get_role_ids()
-                    roles = self.db.query(Role).filter(Role.id.in_(role_ids)).all()
+                    roles = db.query(Role).filter(Role.id.in_(role_ids)).all()
                     roles = [
                         {
                             "id": role.id,
@@ -419,14 +484,14 @@ class AuthService:
                     }
                 }
             except Exception as e:
-                self.db.rollback()
+                db.rollback()
                 logger.error(f"用户登录失败: {email}, 错误: {e}")
                 raise HTTPException(
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                     detail="登录失败，请稍后重试"
                 )
 
-    def refresh_token(self, refresh_token: str) -> dict:
+    def refresh_token(self, db: Session, refresh_token: str) -> dict:
         """刷新访问令牌"""
         payload = verify_token(refresh_token)
         if not payload or payload.get("type") != "refresh":
@@ -443,7 +508,7 @@ class AuthService:
             )
         
         # 验证用户是否存在且活跃
-        user = self.db.query(User).filter(User.email == email).first()
+        user = db.query(User).filter(User.email == email).first()
         if not user or not user.is_active:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -461,7 +526,7 @@ class AuthService:
             "refresh_token": new_refresh_token
         }
 
-    def get_current_user(self, token: str) -> User:
+    def get_current_user(self, db: Session, token: str) -> User:
         """获取当前用户"""
         payload = verify_token(token)
         if not payload:
@@ -477,7 +542,7 @@ class AuthService:
                 detail="无效的令牌数据"
             )
         
-        user = self.db.query(User).filter(User.email == email).first()
+        user = db.query(User).filter(User.email == email).first()
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -490,4 +555,8 @@ class AuthService:
                 detail="用户已被禁用"
             )
         
-        return user
\ No newline at end of file
+        return user
+
+
+# 创建认证服务实例
+auth_service = AuthService()
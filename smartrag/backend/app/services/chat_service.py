@@ -1,86 +1,292 @@
-from typing import List, Dict, Any, Optional, AsyncGenerator
+from typing import List, Dict, Any, Mapping, Optional, AsyncGenerator, Set, Tuple
 import asyncio
+import hashlib
+import json
 import random
+import time
 import httpx
+import orjson
+from collections import OrderedDict
+from types import MappingProxyType
 from datetime import datetime
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError
 from app.schemas.chat import ChatRequest, ChatResponse
 from app.config import settings
 from app.utils.logger import logger
+from app.utils.tokens import estimate_tokens
 from app.services.session_manager import user_session_manager
 from app.database import get_db_context
 from app.models.document import PublicDocument, PersonalDocument
 
+# 默认系统提示（模块级只读常量，按引用复用）
+_SYSTEM_MSG: Mapping[str, str] = MappingProxyType({"role": "system", "content": "你是一个智能助手，请根据用户的问题提供准确、有用的回答。"})
+
+# 历史记录角色到 API 角色的映射（"model"转换为"assistant"以符合API要求）
+_ROLE_MAP = {"model": "assistant"}
+
+# 知识库检索命中时的固定说明，置于知识库内容之前，便于上游按前缀缓存
+_RAG_INSTRUCTIONS = (
+    "请根据用户的问题和以下知识库内容提供准确、有用的回答。"
+    "你的核心目标是准确、清晰地回答用户的问题，而不是展示图片。"
+    "只有当图片能够显著增强回答的可读性和理解度时，才在回答中包含图片。如果图片对回答问题没有实质性帮助，就不要展示。"
+    "知识库内容中可能包含Markdown格式的图片链接（如![图片描述](图片URL)），请仅在图片对回答问题有帮助时保留这些图片链接。"
+    "回答完问题后，请在回答尾部直接添加下方给出的参考文献文本，不要重新格式化或修改参考文献。"
+)
+
+# 知识库系统消息的固定片段
+_RAG_PREFIX = _RAG_INSTRUCTIONS + "\n\n知识库内容：\n"
+_RAG_MIDDLE = "\n\n**参考文献：**\n"
+
+# RAG 检索结果缓存容量与有效期（秒）
+_RAG_CACHE_MAX_ENTRIES = 1024
+_RAG_CACHE_TTL = 300
+
+# 超过该大小（字节）的 RAG 响应在线程中解析
+_RAG_PARSE_OFFLOAD_BYTES = 1 << 20
+
+# 模拟流式输出时每次发送的字符数
+_SIMULATION_CHUNK_CHARS = 8
+
+
+def _build_rag_system(rag_context: str, refs_joined: str) -> str:
+    """拼接知识库系统消息：固定说明 + 知识库内容 + 参考文献"""
+    return "".join((_RAG_PREFIX, rag_context, _RAG_MIDDLE, refs_joined))
+
+
+def _trim_to_budget(messages: List[Dict[str, str]], budget: int) -> List[Dict[str, str]]:
+    """保留开头的系统消息（提示与摘要）和最后的用户消息，超出预算时从最早的历史消息开始丢弃"""
+    costs = [estimate_tokens(msg["content"]) for msg in messages]
+    total = sum(costs)
+    if total <= budget:
+        return messages
+    
+    head = 0
+    while head < len(messages) - 1 and messages[head]["role"] == "system":
+        head += 1
+    
+    drop = head
+    while drop < len(messages) - 1 and total > budget:
+        total -= costs[drop]
+        drop += 1
+    
+    logger.warning("上下文超出 token 预算 {}，丢弃最早的 {} 条历史消息", budget, drop - head)
+    return messages[:head] + messages[drop:]
+
+
+def _cached_prompt_tokens(response: Any) -> Optional[int]:
+    """读取上游返回的前缀缓存命中 token 数（接口不支持时为 None）"""
+    details = getattr(getattr(response, "usage", None), "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None)
+
 
 class ChatService:
     """聊天服务类，处理消息生成和回复"""
     
     def __init__(self):
-        # 初始化 AsyncOpenAI 客户端，使用 SiliconFlow 的 API
+        # 长连接 HTTP 客户端，复用到 SiliconFlow 的 TCP/TLS 连接
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=1000,
+                max_keepalive_connections=200,
+                keepalive_expiry=30.0
+            ),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            http2=True
+        )
+        
+        # 初始化 AsyncOpenAI 客户端，使用 SiliconFlow 的 API；关闭 SDK 自带重试，限流重试由 _create_completion 统一处理
         self.client = AsyncOpenAI(
             api_key=settings.siliconflow_api_key,
-            base_url=settings.siliconflow_base_url
+            base_url=settings.siliconflow_base_url,
+            http_client=self._http,
+            max_retries=0
         )
         self.model = settings.siliconflow_model
         
-        # RAG API 配置
+        # 限制同时进行中的 LLM 调用数，避免突发流量触发上游限流
+        self._llm_sem = asyncio.Semaphore(settings.llm_max_concurrency or 32)
+        
+        # 进行中的非流式请求，相同 (模型, 消息) 的并发请求共享同一次上游调用
+        self._inflight: Dict[bytes, asyncio.Future] = {}
+        
+        # 语义回复缓存（仅在配置开启时创建，未开启时不加载 numpy）
+        self._semantic_cache = None
+        if settings.semantic_cache_enabled:
+            from app.services.semantic_cache import SemanticResponseCache
+            self._semantic_cache = SemanticResponseCache(
+                threshold=settings.semantic_cache_threshold,
+                max_entries=settings.semantic_cache_max_entries
+            )
+        
+        # 非流式回复的 LRU 缓存，键为 (模型, 消息) 的 SHA-256 摘要
+        self._resp_cache: "OrderedDict[bytes, Any]" = OrderedDict()
+        
+        # 后台写入任务的强引用，防止任务在完成前被回收
+        self._background_tasks: Set[asyncio.Task] = set()
+        
+        # 会话管理器初始化结果（首次使用时创建），并发请求等待同一次初始化
+        self._init_future: Optional[asyncio.Future] = None
+        
+        # RAG API 配置，复用长连接避免每次检索重新建立连接
         self.rag_api_url = "http://10.168.27.191:8888/rag/query"
+        self._rag_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=30.0
+            ),
+            timeout=30.0
+        )
+        
+        # RAG 检索结果缓存：键 -> (过期时间, 结果)，以及进行中的同键请求
+        self._rag_cache: Dict[bytes, Tuple[float, dict]] = {}
+        self._rag_inflight: Dict[bytes, asyncio.Future] = {}
         
         # 备用模拟回复（当 API 不可用时使用）
-        self.simulation_responses = [
+        self.simulation_responses = (
             "收到",
             "已收到您的消息",
             "消息已处理",
             "收到，正在处理中",
             "已收到，感谢您的反馈"
-        ]
+        )
+        # 实例级随机数生成器，避免共享模块级 random 的内部锁
+        self._rng = random.Random()
         
-        logger.info(f"ChatService 初始化完成，使用模型: {self.model}")
+        logger.info("ChatService 初始化完成，使用模型: {}", self.model)
+    
+    async def aclose(self):
+        """等待未完成的后台写入，并关闭 HTTP 连接池"""
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        await self._rag_client.aclose()
+        await self._http.aclose()
+        logger.info("ChatService HTTP 连接池已关闭")
     
     def _prepare_messages(self, message: str, history: List[Dict[str, Any]] = None) -> List[Dict[str, str]]:
         """准备发送给 API 的消息格式"""
-        messages = []
-        
-        # 添加系统提示
-        messages.append({
-            "role": "system",
-            "content": "你是一个智能助手，请根据用户的问题提供准确、有用的回答。"
-        })
-        
-        # 添加历史对话
-        if history:
-            for item in history:
-                if item.get("role") and item.get("content"):
-                    # 将"model"角色转换为"assistant"以符合API要求
-                    role = item["role"]
-                    if role == "model":
-                        role = "assistant"
-                    
-                    messages.append({
-                        "role": role,
-                        "content": item["content"]
-                    })
-        
-        # 添加当前用户消息
-        messages.append({
-            "role": "user",
-            "content": message
-        })
-        
-        return messages
+        # 系统提示 + 历史对话 + 当前用户消息
+        return [
+            _SYSTEM_MSG,
+            *(
+                {"role": _ROLE_MAP.get(role, role), "content": content}
+                for item in (history or ())
+                if (role := item.get("role")) and (content := item.get("content"))
+            ),
+            {"role": "user", "content": message}
+        ]
+    
+    async def _safe_add_message(self, user_id: int, conversation_id: str, role: str, content: str):
+        """添加消息到会话，失败时仅记录警告"""
+        try:
+            await user_session_manager.add_message(user_id, conversation_id, role, content)
+        except Exception as e:
+            logger.warning("添加助手回复到会话失败: {}", e)
+    
+    def _spawn_add_message(self, user_id: int, conversation_id: str, role: str, content: str):
+        """在后台写入消息，不阻塞回复返回给客户端"""
+        task = asyncio.create_task(self._safe_add_message(user_id, conversation_id, role, content))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    async def _embed(self, text: str) -> Optional[List[float]]:
+        """计算文本向量，失败时返回 None（不影响正常回复）"""
+        try:
+            result = await self.client.embeddings.create(model=settings.embedding_model, input=text)
+            return result.data[0].embedding
+        except Exception as e:
+            logger.warning("计算文本向量失败，跳过语义缓存: {}", e)
+            return None
     
-    async def _prepare_messages_with_summary(self, user_id: int, message: str, conversation_id: Optional[str] = None) -> List[Dict[str, str]]:
-        """准备发送给 API 的消息格式（包含摘要）"""
-        # 使用会话管理器获取包含摘要的上下文
-        context = await user_session_manager.get_conversation_context(user_id, conversation_id)
+    async def _ensure_init(self):
+        """确保会话管理器只初始化一次，后续请求直接等待已完成的初始化；初始化失败时等待者收到同一异常"""
+        if self._init_future is None:
+            future = self._init_future = asyncio.get_running_loop().create_future()
+            try:
+                logger.info("正在初始化会话管理器...")
+                await user_session_manager.initialize()
+            except Exception as e:
+                # 把异常传给等待者，并允许下一个请求重试
+                self._init_future = None
+                future.set_exception(e)
+                # 标记异常已被读取，没有等待者时不会出现未读取异常的警告
+                future.exception()
+                raise
+            except BaseException:
+                # 初始化请求被取消时同样允许下一个请求重试
+                self._init_future = None
+                future.cancel()
+                raise
+            future.set_result(None)
+        else:
+            # shield 防止某个等待者被取消时连带取消共享的初始化结果
+            await asyncio.shield(self._init_future)
+    
+    async def _ensure_session_and_messages(
+        self,
+        user_id: Optional[int],
+        conversation_id: Optional[str],
+        message: str,
+        history: List[Dict[str, Any]] = None
+    ) -> Tuple[Optional[str], List[Dict[str, str]]]:
+        """
+        确保用户会话可用，写入用户消息并准备发送给 API 的消息
         
-        # 添加当前用户消息
-        context.append({
-            "role": "user",
-            "content": message
-        })
+        Returns:
+            (cid, messages)：cid 为实际使用的会话ID；会话管理器不可用时为 None，消息降级为传入的历史记录
+        """
+        # 如果提供了用户ID，使用会话管理器获取历史记录
+        if user_id is None:
+            logger.warning("未提供用户ID，无法使用会话管理器")
+            return None, self._prepare_messages(message, history)
         
-        return context
+        try:
+            # 确保会话管理器已初始化
+            await self._ensure_init()
+            
+            logger.info("获取用户 {} 的会话...", user_id)
+            # 获取用户会话
+            session = await user_session_manager.get_user_session(user_id, conversation_id)
+            cid = session.conversation_id
+            logger.opt(lazy=True).info(
+                "当前会话ID: {}, 消息数量: {}, 对话轮数: {}",
+                lambda: cid, lambda: len(session.messages), session.get_rounds
+            )
+            
+            # 如果提供了会话ID且与当前会话不匹配，创建新会话
+            if conversation_id and conversation_id != cid:
+                logger.info("会话ID不匹配，创建新会话。旧会话ID: {}, 新会话ID: {}", cid, conversation_id)
+                session = await user_session_manager.switch_session(user_id, conversation_id)
+                cid = session.conversation_id
+                logger.info("新会话已创建并保存")
+            
+            logger.info("添加用户消息到会话: {}...", message[:50])
+            # 添加用户消息到会话，并获取包含摘要的上下文
+            messages = await user_session_manager.add_user_message_and_get_context(user_id, cid, message)
+            return cid, messages
+            
+        except Exception as e:
+            logger.error("使用会话管理器失败，使用传入的历史记录: {}", e)
+            logger.opt(exception=True).debug("会话管理器异常详情")
+            # 降级使用传入的历史记录
+            return None, self._prepare_messages(message, history)
+    
+    def _cache_key(self, messages: List[Mapping[str, str]]) -> bytes:
+        """计算 (模型, 消息) 的缓存键"""
+        payload = json.dumps((self.model, messages), sort_keys=True, ensure_ascii=False, default=dict)
+        return hashlib.sha256(payload.encode("utf-8")).digest()[:16]
+    
+    async def _create_completion(self, params: Dict[str, Any]) -> Any:
+        """在并发上限内调用上游接口，被限流时重试一次"""
+        async with self._llm_sem:
+            try:
+                return await self.client.chat.completions.create(**params)
+            except RateLimitError:
+                # 被限流时带抖动退避后重试一次，仍占用并发名额以形成背压
+                delay = 0.5 + self._rng.random()
+                logger.warning("LLM API 被限流，{:.2f} 秒后重试", delay)
+                await asyncio.sleep(delay)
+                return await self.client.chat.completions.create(**params)
     
     async def _call_llm_api(self, messages: List[Dict[str, str]], stream: bool = False) -> Any:
         """调用 LLM API"""
@@ -91,10 +297,37 @@ class ChatService:
                 "stream": stream
             }
             
-            logger.info(f"调用 LLM API，模型: {self.model}, 流式: {stream}")
-            return await self.client.chat.completions.create(**params)
+            if stream:
+                logger.info("调用 LLM API，模型: {}, 流式: {}", self.model, stream)
+                return await self._create_completion(params)
+            
+            cache_key = self._cache_key(messages)
+            if settings.enable_cache:
+                cached = self._resp_cache.get(cache_key)
+                if cached is not None:
+                    self._resp_cache.move_to_end(cache_key)
+                    logger.info("命中 LLM 回复缓存，模型: {}", self.model)
+                    return cached
+            
+            # 相同请求正在进行中时直接等待其结果，不再重复调用上游
+            task = self._inflight.get(cache_key)
+            if task is not None:
+                logger.info("复用进行中的相同 LLM 请求，模型: {}", self.model)
+                return await asyncio.shield(task)
+            
+            logger.info("调用 LLM API，模型: {}, 流式: {}", self.model, stream)
+            task = asyncio.ensure_future(self._create_completion(params))
+            self._inflight[cache_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(cache_key, None))
+            response = await asyncio.shield(task)
+            
+            if settings.enable_cache:
+                self._resp_cache[cache_key] = response
+                if len(self._resp_cache) > settings.llm_cache_max_entries:
+                    self._resp_cache.popitem(last=False)
+            return response
         except Exception as e:
-            logger.error(f"调用 LLM API 失败: {str(e)}")
+            logger.error("调用 LLM API 失败: {}", e)
             raise
     
     async def generate_response(self, request: ChatRequest) -> ChatResponse:
@@ -109,7 +342,7 @@ class ChatService:
         """
         try:
             # 记录请求
-            logger.info(f"收到聊天请求: {request.message[:50]}...")
+            logger.info("收到聊天请求: {}...", request.message[:50])
             
             # 准备消息
             messages = self._prepare_messages(request.message, request.history)
@@ -119,28 +352,31 @@ class ChatService:
                 response = await self._call_llm_api(messages, stream=False)
                 response_text = response.choices[0].message.content
                 
-                logger.info(f"LLM API 返回回复: {response_text[:50]}...")
+                logger.info("LLM API 返回回复: {}...", response_text[:50])
             except Exception as api_error:
-                logger.warning(f"LLM API 调用失败，使用模拟回复: {str(api_error)}")
+                logger.warning("LLM API 调用失败，使用模拟回复: {}", api_error)
                 # API 调用失败时使用模拟回复
-                await asyncio.sleep(0.5 + random.random() * 1.0)
-                response_text = random.choice(self.simulation_responses)
+                await asyncio.sleep(0.5 + self._rng.random() * 1.0)
+                response_text = self._rng.choice(self.simulation_responses)
+            
+            # 读取一次时钟，会话ID与响应时间戳共用
+            now_ns = time.time_ns()
             
             # 生成或使用提供的会话ID
-            conversation_id = request.conversation_id or f"conv_{datetime.now().timestamp()}"
+            conversation_id = request.conversation_id or f"conv_{now_ns}"
             
             # 创建响应
             response = ChatResponse(
                 message=response_text,
                 conversation_id=conversation_id,
-                timestamp=datetime.now()
+                timestamp=datetime.fromtimestamp(now_ns / 1e9)
             )
             
-            logger.info(f"生成聊天回复: {response_text[:50]}...")
+            logger.info("生成聊天回复: {}...", response_text[:50])
             return response
             
         except Exception as e:
-            logger.error(f"生成聊天回复时出错: {str(e)}")
+            logger.error("生成聊天回复时出错: {}", e)
             # 返回错误响应
             return ChatResponse(
                 message="抱歉，处理您的请求时出现了错误，请稍后再试。",
@@ -149,103 +385,197 @@ class ChatService:
             )
     
     async def _call_rag_api(self, query: str, knowledge_name: str) -> dict:
-        """调用 RAG API 进行知识检索"""
+        """调用 RAG API 进行知识检索（相同查询在 TTL 内直接复用结果）"""
+        key = hashlib.blake2b(f"{knowledge_name}|{' '.join(query.split())}".encode("utf-8"), digest_size=16).digest()
+        
+        cached = self._rag_cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            logger.info("命中 RAG 检索缓存: knowledge_name={}", knowledge_name)
+            return cached[1]
+        
+        # 同一查询并发未命中时只请求一次，其余等待同一任务的结果
+        task = self._rag_inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_rag(query, knowledge_name))
+            self._rag_inflight[key] = task
+            task.add_done_callback(lambda t: self._on_rag_done(key, t))
+        return await asyncio.shield(task)
+    
+    def _on_rag_done(self, key: bytes, task: asyncio.Task):
+        """RAG 请求完成后移出进行中表，成功结果写入缓存"""
+        self._rag_inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None and task.result()["status"] != "error":
+            self._store_rag_result(key, task.result())
+    
+    def _store_rag_result(self, key: bytes, result: dict):
+        """写入 RAG 缓存，超出容量时先清理过期项，再淘汰最早写入的项"""
+        now = time.monotonic()
+        if len(self._rag_cache) >= _RAG_CACHE_MAX_ENTRIES:
+            for k in [k for k, (expires_at, _) in self._rag_cache.items() if expires_at <= now]:
+                del self._rag_cache[k]
+            while len(self._rag_cache) >= _RAG_CACHE_MAX_ENTRIES:
+                self._rag_cache.pop(next(iter(self._rag_cache)))
+        self._rag_cache[key] = (now + _RAG_CACHE_TTL, result)
+    
+    async def _fetch_rag(self, query: str, knowledge_name: str) -> dict:
+        """请求 RAG API 并整理检索结果"""
         try:
-            logger.info(f"调用 RAG API: query={query[:50]}..., knowledge_name={knowledge_name}")
-            
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    self.rag_api_url,
-                    data={
-                        "query": query,
-                        "knowledge_name": knowledge_name
-                    }
-                )
-                response.raise_for_status()
-                result = response.json()
-                
-                logger.info(f"RAG API 返回结果: {result}")
-                
-                status = result.get("status", "")
-                data = result.get("data", {})
-                
-                if not isinstance(data, dict):
-                    logger.error(f"RAG API 返回的 data 不是字典类型: {type(data)}")
-                    return {
-                        "status": status,
-                        "context": "",
-                        "references": []
-                    }
-                
-                chunks = data.get("chunks", [])
-                # references = data.get("references", [])
-                
-                if not isinstance(chunks, list):
-                    logger.error(f"RAG API 返回的 chunks 不是列表类型: {type(chunks)}")
-                    return {
-                        "status": status,
-                        "context": "",
-                        "references": []
-                    }
-                
-                if len(chunks) == 0:
-                    logger.warning(f"RAG 检索未找到相关内容，status: {status}")
-                    return {
-                        "status": status,
-                        "context": "",
-                        "references": []
-                    }
-                
-                rag_contents, rag_files = [], []
-                chunks_selected = chunks[:3] if len(chunks) > 3 else chunks
-                unique_files = set()
-                
-                for i, chunk in enumerate(chunks_selected):
-                    content = chunk.get("content", "")
-                    file_path = chunk.get("file_path", "")
-                    if content:
-                        rag_contents.append(f"文献[{i+1}]:{content}")
-                    if file_path and file_path not in unique_files:
-                        unique_files.add(file_path)
-                        original_filename = await self._get_filename_by_minio_name(file_path)
-                        display_filename = original_filename if original_filename else file_path
-                        rag_files.append(f"文献[{i+1}]:{display_filename}")
-                
-                rag_context = "\n\n".join(rag_contents)
-                logger.info(f"RAG 检索成功，找到 {len(rag_contents)} 个相关内容片段，{len(rag_files)} 个唯一参考文献")
-                
+            logger.info("调用 RAG API: query={}..., knowledge_name={}", query[:50], knowledge_name)
+            
+            response = await self._rag_client.post(
+                self.rag_api_url,
+                data={
+                    "query": query,
+                    "knowledge_name": knowledge_name
+                }
+            )
+            response.raise_for_status()
+            # 较大的检索结果放到线程中解析，避免阻塞事件循环
+            body = response.content
+            if len(body) > _RAG_PARSE_OFFLOAD_BYTES:
+                result = await asyncio.to_thread(orjson.loads, body)
+            else:
+                result = orjson.loads(body)
+            
+            logger.debug("RAG API 返回结果: {}", result)
+            
+            status = result.get("status", "")
+            data = result.get("data", {})
+            
+            if not isinstance(data, dict):
+                logger.error("RAG API 返回的 data 不是字典类型: {}", type(data))
                 return {
                     "status": status,
-                    "context": rag_context,
-                    "references": rag_files
+                    "context": "",
+                    "references": [],
+                    "references_joined": ""
                 }
+            
+            chunks = data.get("chunks", [])
+            # references = data.get("references", [])
+            
+            if not isinstance(chunks, list):
+                logger.error("RAG API 返回的 chunks 不是列表类型: {}", type(chunks))
+                return {
+                    "status": status,
+                    "context": "",
+                    "references": [],
+                    "references_joined": ""
+                }
+            
+            if len(chunks) == 0:
+                logger.warning("RAG 检索未找到相关内容，status: {}", status)
+                return {
+                    "status": status,
+                    "context": "",
+                    "references": [],
+                    "references_joined": ""
+                }
+            
+            rag_contents, rag_files = [], []
+            chunks_selected = chunks[:3] if len(chunks) > 3 else chunks
+            unique_files = set()
+            
+            # 一次查询取回所有引用文件的原始文件名
+            filenames = await self._get_filenames_bulk(
+                {chunk.get("file_path") for chunk in chunks_selected if chunk.get("file_path")}
+            )
+            
+            for i, chunk in enumerate(chunks_selected):
+                content = chunk.get("content", "")
+                file_path = chunk.get("file_path", "")
+                if content:
+                    rag_contents.append(f"文献[{i+1}]:{content}")
+                if file_path and file_path not in unique_files:
+                    unique_files.add(file_path)
+                    display_filename = filenames.get(file_path) or file_path
+                    rag_files.append(f"文献[{i+1}]:{display_filename}")
+            
+            rag_context = "\n\n".join(rag_contents)
+            logger.info("RAG 检索成功，找到 {} 个相关内容片段，{} 个唯一参考文献", len(rag_contents), len(rag_files))
+            
+            return {
+                "status": status,
+                "context": rag_context,
+                "references": rag_files,
+                "references_joined": "\n".join(rag_files)
+            }
         except Exception as e:
-            logger.error(f"调用 RAG API 失败: {str(e)}")
+            logger.error("调用 RAG API 失败: {}", e)
             return {
                 "status": "error",
                 "context": "",
-                "references": []
+                "references": [],
+                "references_joined": ""
             }
     
-    async def _get_filename_by_minio_name(self, minio_filename: str) -> Optional[str]:
-        """根据 MinIO 文件名查询原始文件名"""
-        if not minio_filename:
-            return None
-        
+    async def _retrieve_rag(self, message: str, knowledge_name: str) -> Tuple[str, str]:
+        """执行知识检索，返回 (上下文, 换行拼接的参考文献)，失败时返回空字符串"""
+        try:
+            rag_result = await self._call_rag_api(message, knowledge_name)
+            rag_context: str = rag_result["context"]
+            if rag_context:
+                logger.info("RAG 检索成功，状态: {}, 上下文长度: {}, {} 个引用", rag_result["status"], len(rag_context), len(rag_result["references"]))
+            else:
+                logger.warning("RAG 检索返回空结果，状态: {}", rag_result["status"])
+            return rag_context, rag_result["references_joined"]
+        except Exception as e:
+            logger.error("RAG 检索失败: {}", e)
+            return "", ""
+    
+    async def _get_filenames_bulk(self, minio_filenames: Set[str]) -> Dict[str, str]:
+        """根据 MinIO 文件名批量查询原始文件名（同步数据库查询在线程中执行）"""
+        if not minio_filenames:
+            return {}
+        return await asyncio.to_thread(self._get_filenames_bulk_sync, minio_filenames)
+    
+    def _get_filenames_bulk_sync(self, minio_filenames: Set[str]) -> Dict[str, str]:
+        """根据 MinIO 文件名批量查询原始文件名，公共文档优先"""
         try:
             with get_db_context() as db:
-                public_doc = db.query(PublicDocument).filter(PublicDocument.minio_filename == minio_filename).first()
-                if public_doc:
-                    return public_doc.filename
-                
-                personal_doc = db.query(PersonalDocument).filter(PersonalDocument.minio_filename == minio_filename).first()
-                if personal_doc:
-                    return personal_doc.filename
+                personal_docs = db.query(PersonalDocument.minio_filename, PersonalDocument.filename).filter(
+                    PersonalDocument.minio_filename.in_(minio_filenames)
+                ).all()
+                public_docs = db.query(PublicDocument.minio_filename, PublicDocument.filename).filter(
+                    PublicDocument.minio_filename.in_(minio_filenames)
+                ).all()
                 
-                return None
+                filenames = dict(personal_docs)
+                filenames.update(public_docs)
+                return filenames
         except Exception as e:
-            logger.error(f"查询文件名失败: {str(e)}")
-            return None
+            logger.error("查询文件名失败: {}", e)
+            return {}
+    
+    async def _prepare_session_and_messages(
+        self,
+        user_id: Optional[int],
+        conversation_id: Optional[str],
+        message: str,
+        history: Optional[List[Dict[str, Any]]],
+        knowledge_retrieval: bool,
+        knowledge_name: Optional[str]
+    ) -> Tuple[Optional[str], List[Dict[str, str]]]:
+        """准备会话与发送给 API 的消息，启用知识检索时追加知识库系统消息"""
+        # 如果启用了知识检索，RAG 检索与会话准备并发进行
+        rag_task = None
+        if knowledge_retrieval and knowledge_name:
+            rag_task = asyncio.create_task(self._retrieve_rag(message, knowledge_name))
+        
+        cid, messages = await self._ensure_session_and_messages(user_id, conversation_id, message, history)
+        messages = _trim_to_budget(messages, settings.llm_context_token_budget)
+        
+        # 如果有 RAG 上下文，追加知识库系统消息
+        if rag_task is not None:
+            rag_context, refs_joined = await rag_task
+            if rag_context and refs_joined:
+                # 静态前缀保持不变，知识库内容作为独立系统消息追加在当前用户消息之前
+                messages.insert(len(messages) - 1, {
+                    "role": "system",
+                    "content": _build_rag_system(rag_context, refs_joined)
+                })
+        
+        return cid, messages
     
     async def process_message_with_history(
         self, 
@@ -274,96 +604,64 @@ class ChatService:
         """
         try:
             # 记录请求
-            logger.info(f"处理消息: {message[:50]}...")
-            logger.info(f"用户ID: {user_id}, 会话ID: {conversation_id}, 用户角色: {user_role}")
-            logger.info(f"知识检索: {knowledge_retrieval}, 知识库名称: {knowledge_name}")
-            
-            rag_context = ""
-            
-            # 如果启用了知识检索，调用 RAG API
-            if knowledge_retrieval and knowledge_name:
-                try:
-                    rag_result = await self._call_rag_api(message, knowledge_name)
-                    rag_context = rag_result.get("context", [])
-                    rag_files = rag_result.get("references", [])
-                    if rag_context:
-                        logger.info(f"RAG 检索成功，状态: {rag_result.get('status')}, 上下文长度: {len(rag_context)}, {len(rag_result.get('references', []))} 个引用")
-                    else:
-                        logger.warning(f"RAG 检索返回空结果，状态: {rag_result.get('status')}")
-                except Exception as e:
-                    logger.error(f"RAG 检索失败: {str(e)}")
-            
-            # 如果提供了用户ID，使用会话管理器获取历史记录
-            if user_id is not None:
-                try:
-                    logger.info(f"正在为用户 {user_id} 初始化会话管理器...")
-                    # 确保会话管理器已初始化
-                    await user_session_manager.initialize()
-                    
-                    logger.info(f"获取用户 {user_id} 的会话...")
-                    # 获取用户会话
-                    session = await user_session_manager.get_user_session(user_id, conversation_id)
-                    logger.info(f"当前会话ID: {session.conversation_id}, 消息数量: {len(session.messages)}, 对话轮数: {session.get_rounds()}")
-                    
-                    # 如果提供了会话ID且与当前会话不匹配，创建新会话
-                    if conversation_id and conversation_id != session.conversation_id:
-                        logger.info(f"会话ID不匹配，创建新会话。旧会话ID: {session.conversation_id}, 新会话ID: {conversation_id}")
-                        await user_session_manager.clear_session(user_id)
-                        session = await user_session_manager.get_user_session(user_id, conversation_id)
-                        logger.info(f"新会话已创建并保存")
-                    
-                    logger.info(f"添加用户消息到会话: {message[:50]}...")
-                    # 添加用户消息到会话
-                    await user_session_manager.add_message(user_id, session.conversation_id, "user", message)
-                    
-                    # 使用带摘要的上下文准备消息
-                    messages = await self._prepare_messages_with_summary(user_id, message, session.conversation_id)
-                    
-                except Exception as e:
-                    logger.error(f"使用会话管理器失败，使用传入的历史记录: {str(e)}")
-                    logger.exception(e)
-                    # 降级使用传入的历史记录
-                    messages = self._prepare_messages(message, history)
-            else:
-                logger.warning("未提供用户ID，无法使用会话管理器")
-                messages = self._prepare_messages(message, history)
+            logger.info("处理消息: {}...", message[:50])
+            logger.info("用户ID: {}, 会话ID: {}, 用户角色: {}", user_id, conversation_id, user_role)
+            logger.info("知识检索: {}, 知识库名称: {}", knowledge_retrieval, knowledge_name)
+            
+            # 语义缓存只用于未启用知识检索的请求，向量计算与会话准备并发进行
+            embed_task = None
+            if self._semantic_cache is not None and not (knowledge_retrieval and knowledge_name):
+                embed_task = asyncio.create_task(self._embed(message))
+            
+            # 准备会话、消息与知识库上下文
+            cid, messages = await self._prepare_session_and_messages(
+                user_id, conversation_id, message, history, knowledge_retrieval, knowledge_name
+            )
             
-            # 如果有 RAG 上下文，添加到系统提示中
-            if rag_context and rag_files:
-                messages[0]["content"] = f"你是一个智能助手，请根据用户的问题和以下知识库内容提供准确、有用的回答。\n\n知识库内容：\n{rag_context}\n\n请基于以上知识库内容回答用户的问题。你的核心目标是准确、清晰地回答用户的问题，而不是展示图片。只有当图片能够显著增强回答的可读性和理解度时，才在回答中包含图片。如果图片对回答问题没有实质性帮助，就不要展示。回答完问题后，请在回答尾部直接添加以下参考文献文本，不要重新格式化或修改参考文献：\n\n**参考文献：**\n{chr(10).join(rag_files)}\n\n注意：知识库内容中可能包含Markdown格式的图片链接（如![图片描述](图片URL)），请仅在图片对回答问题有帮助时保留这些图片链接。"
+            embedding = await embed_task if embed_task is not None else None
+            # 回复只依赖当前问题时才可复用：会话中已有摘要或历史消息时不使用语义缓存
+            if len(messages) != 2:
+                embedding = None
+            # 作用域包含模型与系统提示，更换任一项后旧回复不再命中
+            cache_scope = (self.model, messages[0]["content"])
+            if embedding is not None:
+                cached_text = self._semantic_cache.lookup(embedding, cache_scope)
+                if cached_text is not None:
+                    logger.info("命中语义回复缓存: {}...", cached_text[:50])
+                    if cid is not None:
+                        self._spawn_add_message(user_id, cid, "assistant", cached_text)
+                    return cached_text
             
             try:
                 # 调用 LLM API
                 response = await self._call_llm_api(messages, stream=False)
                 response_text = response.choices[0].message.content
+                logger.opt(lazy=True).debug("LLM 前缀缓存命中 token 数: {}", lambda: _cached_prompt_tokens(response))
+                
+                if embedding is not None and response_text:
+                    self._semantic_cache.add(embedding, response_text, cache_scope)
                 
                 # 如果提供了用户ID，将助手回复添加到会话
-                if user_id is not None:
-                    try:
-                        await user_session_manager.add_message(user_id, session.conversation_id, "assistant", response_text)
-                    except Exception as e:
-                        logger.warning(f"添加助手回复到会话失败: {str(e)}")
+                if cid is not None:
+                    self._spawn_add_message(user_id, cid, "assistant", response_text)
                 
-                logger.info(f"LLM API 返回回复: {response_text[:50]}...")
+                logger.info("LLM API 返回回复: {}...", response_text[:50])
                 return response_text
             except Exception as api_error:
-                logger.warning(f"LLM API 调用失败，使用模拟回复: {str(api_error)}")
+                logger.warning("LLM API 调用失败，使用模拟回复: {}", api_error)
                 # API 调用失败时使用模拟回复
-                await asyncio.sleep(0.5 + random.random() * 1.0)
-                response_text = random.choice(self.simulation_responses)
+                await asyncio.sleep(0.5 + self._rng.random() * 1.0)
+                response_text = self._rng.choice(self.simulation_responses)
                 
                 # 如果提供了用户ID，将助手回复添加到会话
-                if user_id is not None:
-                    try:
-                        await user_session_manager.add_message(user_id, session.conversation_id, "assistant", response_text)
-                    except Exception as e:
-                        logger.warning(f"添加助手回复到会话失败: {str(e)}")
+                if cid is not None:
+                    self._spawn_add_message(user_id, cid, "assistant", response_text)
                 
-                logger.info(f"生成回复: {response_text}")
+                logger.info("生成回复: {}", response_text)
                 return response_text
             
         except Exception as e:
-            logger.error(f"处理消息时出错: {str(e)}")
+            logger.error("处理消息时出错: {}", e)
             return "抱歉，处理您的请求时出现了错误，请稍后再试。"
     
     async def stream_response(
@@ -393,67 +691,17 @@ class ChatService:
         """
         try:
             # 记录请求
-            logger.info(f"开始流式处理消息: {message[:50]}...")
-            logger.info(f"用户ID: {user_id}, 会话ID: {conversation_id}, 用户角色: {user_role}")
-            logger.info(f"知识检索: {knowledge_retrieval}, 知识库名称: {knowledge_name}")
-            
-            rag_context = ""
-            
-            # 如果启用了知识检索，调用 RAG API
-            if knowledge_retrieval and knowledge_name:
-                try:
-                    rag_result = await self._call_rag_api(message, knowledge_name)
-                    rag_context = rag_result.get("context", [])
-                    rag_files = rag_result.get("references", [])
-                    
-                    if rag_context:
-                        logger.info(f"RAG 检索成功，状态: {rag_result.get('status')}, 上下文长度: {len(rag_context)}, {len(rag_result.get('references', []))} 个引用")
-                    else:
-                        logger.warning(f"RAG 检索返回空结果，状态: {rag_result.get('status')}")
-                except Exception as e:
-                    logger.error(f"RAG 检索失败: {str(e)}")
-            
-            # 如果提供了用户ID，使用会话管理器获取历史记录
-            if user_id is not None:
-                try:
-                    logger.info(f"正在为用户 {user_id} 初始化会话管理器...")
-                    # 确保会话管理器已初始化
-                    await user_session_manager.initialize()
-                    
-                    logger.info(f"获取用户 {user_id} 的会话...")
-                    # 获取用户会话
-                    session = await user_session_manager.get_user_session(user_id, conversation_id)
-                    logger.info(f"当前会话ID: {session.conversation_id}, 消息数量: {len(session.messages)}, 对话轮数: {session.get_rounds()}")
-                    
-                    # 如果提供了会话ID且与当前会话不匹配，创建新会话
-                    if conversation_id and conversation_id != session.conversation_id:
-                        logger.info(f"会话ID不匹配，创建新会话。旧会话ID: {session.conversation_id}, 新会话ID: {conversation_id}")
-                        await user_session_manager.clear_session(user_id)
-                        session = await user_session_manager.get_user_session(user_id, conversation_id)
-                        logger.info(f"新会话已创建并保存")
-                    
-                    logger.info(f"添加用户消息到会话: {message[:50]}...")
-                    # 添加用户消息到会话
-                    await user_session_manager.add_message(user_id, session.conversation_id, "user", message)
-                    
-                    # 使用带摘要的上下文准备消息
-                    messages = await self._prepare_messages_with_summary(user_id, message, session.conversation_id)
-                    
-                except Exception as e:
-                    logger.error(f"使用会话管理器失败，使用传入的历史记录: {str(e)}")
-                    logger.exception(e)
-                    # 降级使用传入的历史记录
-                    messages = self._prepare_messages(message, history)
-            else:
-                logger.warning("未提供用户ID，无法使用会话管理器")
-                messages = self._prepare_messages(message, history)
+            logger.info("开始流式处理消息: {}...", message[:50])
+            logger.info("用户ID: {}, 会话ID: {}, 用户角色: {}", user_id, conversation_id, user_role)
+            logger.info("知识检索: {}, 知识库名称: {}", knowledge_retrieval, knowledge_name)
             
-            # 如果有 RAG 上下文，添加到系统提示中
-            if rag_context and rag_files:
-                messages[0]["content"] = f"你是一个智能助手，请根据用户的问题和以下知识库内容提供准确、有用的回答。\n\n知识库内容：\n{rag_context}\n\n请基于以上知识库内容回答用户的问题。你的核心目标是准确、清晰地回答用户的问题，而不是展示图片。只有当图片能够显著增强回答的可读性和理解度时，才在回答中包含图片。如果图片对回答问题没有实质性帮助，就不要展示。回答完问题后，请在回答尾部直接添加以下参考文献文本，不要重新格式化或修改参考文献：\n\n**参考文献：**\n{chr(10).join(rag_files)}\n\n注意：知识库内容中可能包含Markdown格式的图片链接（如![图片描述](图片URL)），请仅在图片对回答问题有帮助时保留这些图片链接。"
+            # 准备会话、消息与知识库上下文
+            cid, messages = await self._prepare_session_and_messages(
+                user_id, conversation_id, message, history, knowledge_retrieval, knowledge_name
+            )
             
-            # 收集完整的回复文本，以便后续添加到会话
-            full_response = ""
+            # 收集回复片段，流式结束后一次性拼接并添加到会话
+            parts: List[str] = []
             
             try:
                 # 调用 LLM API (流式)
@@ -463,50 +711,62 @@ class ChatService:
                     if not chunk.choices:
                         continue
                     
+                    # 正文与推理内容（如果模型支持）合并为一个片段输出
                     delta = chunk.choices[0].delta
-                    if delta.content:
-                        full_response += delta.content
-                        yield delta.content
-                    
-                    # 处理推理内容（如果模型支持）
-                    if hasattr(delta, 'reasoning_content') and delta.reasoning_content:
-                        full_response += delta.reasoning_content
-                        yield delta.reasoning_content
+                    text = (delta.content or "") + (getattr(delta, "reasoning_content", None) or "")
+                    if text:
+                        parts.append(text)
+                        yield text
                 
                 # 流式完成后，将完整回复添加到会话
-                if user_id is not None and full_response:
-                    try:
-                        await user_session_manager.add_message(user_id, session.conversation_id, "assistant", full_response)
-                    except Exception as e:
-                        logger.warning(f"添加助手回复到会话失败: {str(e)}")
+                full_response = "".join(parts)
+                if cid is not None and full_response:
+                    self._spawn_add_message(user_id, cid, "assistant", full_response)
                         
             except Exception as api_error:
-                logger.warning(f"LLM API 流式调用失败，使用模拟回复: {str(api_error)}")
+                logger.warning("LLM API 流式调用失败，使用模拟回复: {}", api_error)
                 # API 调用失败时使用模拟回复
-                simulation_text = random.choice(self.simulation_responses)
+                simulation_text = self._rng.choice(self.simulation_responses)
                 
-                # 模拟流式输出
-                for char in simulation_text:
-                    full_response += char
-                    yield char
-                    await asyncio.sleep(0.05)  # 模拟逐字符输出的延迟
+                # 模拟流式输出（每次输出若干字符）
+                for i in range(0, len(simulation_text), _SIMULATION_CHUNK_CHARS):
+                    chunk = simulation_text[i:i + _SIMULATION_CHUNK_CHARS]
+                    parts.append(chunk)
+                    yield chunk
+                    await asyncio.sleep(0.05)  # 模拟流式输出的延迟
                 
                 # 流式完成后，将完整回复添加到会话
-                if user_id is not None and full_response:
-                    try:
-                        await user_session_manager.add_message(user_id, session.conversation_id, "assistant", full_response)
-                    except Exception as e:
-                        logger.warning(f"添加助手回复到会话失败: {str(e)}")
+                full_response = "".join(parts)
+                if cid is not None and full_response:
+                    self._spawn_add_message(user_id, cid, "assistant", full_response)
             
         except Exception as e:
-            logger.error(f"流式处理消息时出错: {str(e)}")
-            error_text = "抱歉，处理您的请求时出现了错误，请稍后再试。"
-            
-            # 模拟流式输出错误消息
-            for char in error_text:
-                yield char
-                await asyncio.sleep(0.05)
+            logger.error("流式处理消息时出错: {}", e)
+            # 一次性输出错误消息，尽快结束响应
+            yield "抱歉，处理您的请求时出现了错误，请稍后再试。"
+
+
+# 聊天服务实例，由应用 lifespan 在事件循环内创建
+_chat_service: Optional[ChatService] = None
+
+
+def create_chat_service() -> ChatService:
+    """创建聊天服务实例（需在运行中的事件循环内调用，使连接池绑定到当前循环）"""
+    global _chat_service
+    _chat_service = ChatService()
+    return _chat_service
+
+
+async def close_chat_service():
+    """关闭聊天服务的连接池并释放实例"""
+    global _chat_service
+    if _chat_service is not None:
+        await _chat_service.aclose()
+        _chat_service = None
 
 
-# 创建聊天服务实例
-chat_service = ChatService()
+async def get_chat_service() -> ChatService:
+    """获取聊天服务实例（异步依赖，直接在事件循环内返回，无需经过线程池）"""
+    if _chat_service is None:
+        return create_chat_service()
+    return _chat_service
@@ -4,7 +4,7 @@
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy import and_, func, update
 from app.models.conversation import Conversation, ConversationMessage, MessageRole
 from app.utils.logger import logger
 
@@ -15,6 +15,14 @@ class ConversationService:
     def __init__(self, db: Session):
         self.db = db
     
+    def _update_conversation(self, conversation_id: str, include_deleted: bool = False, **values) -> bool:
+        """用单条 UPDATE 语句更新会话字段，返回是否命中会话"""
+        conditions = [Conversation.id == conversation_id]
+        if not include_deleted:
+            conditions.append(Conversation.is_deleted == False)
+        result = self.db.execute(update(Conversation).where(*conditions).values(**values))
+        return result.rowcount > 0
+    
     def create_conversation(
         self,
         conversation_id: str,
@@ -23,7 +31,7 @@ class ConversationService:
     ) -> Conversation:
         """创建新会话"""
         try:
-            from datetime import datetime
+            now = datetime.now()
             conversation = Conversation(
                 id=conversation_id,
                 user_id=user_id,
@@ -31,8 +39,8 @@ class ConversationService:
                 message_count=0,
                 total_tokens=0,
                 is_active=True,
-                created_at=datetime.now(),
-                updated_at=datetime.now()
+                created_at=now,
+                updated_at=now
             )
             self.db.add(conversation)
             self.db.commit()
@@ -58,6 +66,13 @@ class ConversationService:
             logger.error(f"获取会话失败: {e}")
             return None
     
+    @staticmethod
+    def _page_total(rows: list, query, skip: int) -> int:
+        """从窗口函数列读取总数；分页越界没有返回行时才单独计数"""
+        if rows:
+            return rows[0].total
+        return query.count() if skip else 0
+    
     def get_user_conversations(
         self,
         user_id: int,
@@ -77,9 +92,10 @@ class ConversationService:
             if is_active is not None:
                 query = query.filter(Conversation.is_active == is_active)
             
-            total = query.count()
-            conversations = query.order_by(Conversation.updated_at.desc()).offset(skip).limit(limit).all()
-            return conversations, total
+            rows = query.add_columns(func.count().over().label("total")).order_by(
+                Conversation.updated_at.desc()
+            ).offset(skip).limit(limit).all()
+            return [row[0] for row in rows], self._page_total(rows, query, skip)
         except Exception as e:
             logger.error(f"获取用户会话列表失败: {e}")
             return [], 0
@@ -91,20 +107,10 @@ class ConversationService:
     ) -> bool:
         """更新会话摘要"""
         try:
-            conversation = self.db.query(Conversation).filter(
-                and_(
-                    Conversation.id == conversation_id,
-                    Conversation.is_deleted == False
-                )
-            ).first()
-            
-            if not conversation:
+            if not self._update_conversation(conversation_id, summary=summary, updated_at=datetime.now()):
                 logger.warning(f"会话不存在: {conversation_id}")
                 return False
             
-            conversation.summary = summary
-            conversation.updated_at = datetime.now()
-            self.db.flush()
             logger.info(f"更新会话摘要: id={conversation_id}")
             return True
         except Exception as e:
@@ -119,22 +125,13 @@ class ConversationService:
     ) -> Optional[Conversation]:
         """更新会话标题"""
         try:
-            conversation = self.db.query(Conversation).filter(
-                and_(
-                    Conversation.id == conversation_id,
-                    Conversation.is_deleted == False
-                )
-            ).first()
-            
-            if not conversation:
+            if not self._update_conversation(conversation_id, title=title, updated_at=datetime.now()):
                 logger.warning(f"会话不存在: {conversation_id}")
                 return None
             
-            conversation.title = title
-            conversation.updated_at = datetime.now()
-            self.db.flush()
             logger.info(f"更新会话标题: id={conversation_id}, title={title}")
-            return conversation
+            # 已加载的会话对象会被同步更新，此处通常直接命中会话的标识映射
+            return self.db.get(Conversation, conversation_id)
         except Exception as e:
             logger.error(f"更新会话标题失败: {e}")
             self.db.rollback()
@@ -148,21 +145,14 @@ class ConversationService:
     ) -> bool:
         """更新会话统计信息"""
         try:
-            conversation = self.db.query(Conversation).filter(
-                and_(
-                    Conversation.id == conversation_id,
-                    Conversation.is_deleted == False
-                )
-            ).first()
-            
-            if not conversation:
+            if not self._update_conversation(
+                conversation_id,
+                message_count=message_count,
+                total_tokens=total_tokens,
+                updated_at=datetime.now()
+            ):
                 logger.warning(f"会话不存在: {conversation_id}")
                 return False
-            
-            conversation.message_count = message_count
-            conversation.total_tokens = total_tokens
-            conversation.updated_at = datetime.now()
-            self.db.flush()
             return True
         except Exception as e:
             logger.error(f"更新会话统计信息失败: {e}")
@@ -180,7 +170,6 @@ class ConversationService:
     ) -> Optional[ConversationMessage]:
         """保存会话消息"""
         try:
-            from datetime import datetime, timedelta
             message = ConversationMessage(
                 conversation_id=conversation_id,
                 message_id=message_id,
@@ -188,7 +177,7 @@ class ConversationService:
                 content=content,
                 tokens=tokens,
                 importance=importance,
-                created_at=datetime.now() if role == MessageRole.user else datetime.now() + timedelta(seconds=1)
+                created_at=datetime.now()
             )
             self.db.add(message)
             self.db.flush()
@@ -199,6 +188,11 @@ class ConversationService:
             self.db.rollback()
             return None
     
+    def save_messages(self, messages: List[Dict[str, Any]]):
+        """批量保存会话消息（按列表顺序插入，由调用方提交）"""
+        self.db.bulk_insert_mappings(ConversationMessage, messages)
+        logger.debug(f"批量保存消息: {len(messages)} 条")
+
     def get_conversation_messages(
         self,
         conversation_id: str,
@@ -211,9 +205,11 @@ class ConversationService:
                 ConversationMessage.conversation_id == conversation_id
             )
             
-            total = query.count()
-            messages = query.order_by(ConversationMessage.created_at.asc()).offset(skip).limit(limit).all()
-            return messages, total
+            # 自增主键作为同一时间戳下的插入顺序
+            rows = query.add_columns(func.count().over().label("total")).order_by(
+                ConversationMessage.created_at.asc(), ConversationMessage.id.asc()
+            ).offset(skip).limit(limit).all()
+            return [row[0] for row in rows], self._page_total(rows, query, skip)
         except Exception as e:
             logger.error(f"获取会话消息失败: {e}")
             return [], 0
@@ -221,17 +217,17 @@ class ConversationService:
     def delete_conversation(self, conversation_id: str) -> bool:
         """删除会话（软删除）"""
         try:
-            conversation = self.db.query(Conversation).filter(
-                Conversation.id == conversation_id
-            ).first()
-            
-            if not conversation:
+            now = datetime.now()
+            if not self._update_conversation(
+                conversation_id,
+                include_deleted=True,
+                is_deleted=True,
+                deleted_at=now,
+                updated_at=now
+            ):
                 logger.warning(f"会话不存在: {conversation_id}")
                 return False
             
-            conversation.is_deleted = True
-            conversation.deleted_at = datetime.now()
-            conversation.updated_at = datetime.now()
             self.db.commit()
             logger.info(f"删除会话: id={conversation_id}")
             return True
@@ -243,17 +239,15 @@ class ConversationService:
     def set_conversation_active(self, conversation_id: str, is_active: bool) -> bool:
         """设置会话活跃状态"""
         try:
-            conversation = self.db.query(Conversation).filter(
-                Conversation.id == conversation_id
-            ).first()
-            
-            if not conversation:
+            if not self._update_conversation(
+                conversation_id,
+                include_deleted=True,
+                is_active=is_active,
+                updated_at=datetime.now()
+            ):
                 logger.warning(f"会话不存在: {conversation_id}")
                 return False
             
-            conversation.is_active = is_active
-            conversation.updated_at = datetime.now()
-            self.db.flush()
             logger.info(f"设置会话活跃状态: id={conversation_id}, is_active={is_active}")
             return True
         except Exception as e:
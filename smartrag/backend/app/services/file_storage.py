@@ -1,14 +1,37 @@
 import os
+import uuid
+import asyncio
 import hashlib
 import shutil
+import urllib3
 from pathlib import Path
-from typing import Tuple, Optional
+from typing import Dict, Tuple, Optional
 from fastapi import UploadFile
 from minio import Minio
 from app.utils.logger import logger
 from app.config import settings
 
 
+# 上传文件分块读取大小
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+def _select_part_size(file_size: int) -> int:
+    """按文件大小选择 MinIO 分片大小，大文件使用更大的分片以减少请求数"""
+    if settings.minio_part_size:
+        return settings.minio_part_size
+    if file_size < (1 << 30):
+        return 16 << 20
+    if file_size < (10 << 30):
+        return 64 << 20
+    return 256 << 20
+
+
+def _new_sha256():
+    """创建 SHA256 哈希对象（走 OpenSSL 实现，支持时自动使用 SHA 硬件指令；仅用于去重，非安全用途）"""
+    return hashlib.new("sha256", usedforsecurity=False)
+
+
 class FileStorageService:
     """文件存储服务"""
     
@@ -17,6 +40,8 @@ class FileStorageService:
         self.base_dir = Path(settings.file_storage_path)
         self.public_dir = self.base_dir / "public"
         self.personal_dir = self.base_dir / "personal"
+        # 基础目录的字符串形式，路径拼接与检查直接使用 os.path，避免每次构造 Path 对象
+        self._base_str = str(self.base_dir)
         
         # MinIO配置 - 从环境变量读取
         self.minio_endpoint = settings.minio_endpoint
@@ -27,13 +52,26 @@ class FileStorageService:
             self.minio_endpoint,
             access_key=self.minio_access_key,
             secret_key=self.minio_secret_key,
-            secure=False
+            secure=False,
+            # 全进程共享的连接池：并发上传及并行分片复用连接，连接池满时临时新建连接而不排队等待
+            http_client=urllib3.PoolManager(
+                num_pools=4,
+                maxsize=64,
+                block=False,
+                retries=urllib3.Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+                timeout=urllib3.Timeout(connect=5, read=300)
+            )
         )
         
+        # 正在上传到MinIO的对象，相同内容的并发上传共用一次上传
+        self._inflight_uploads: Dict[str, asyncio.Task] = {}
+        
+        # MinIO bucket 检查延后到启动后的后台任务，避免导入时阻塞在网络请求上
+        self._bucket_task: Optional[asyncio.Task] = None
+        self._bucket_ready = False
+        
         # 创建目录结构
         self._ensure_directories()
-        # 确保MinIO bucket存在
-        self._ensure_minio_bucket()
     
     def _ensure_directories(self):
         """确保必要的目录存在"""
@@ -58,9 +96,39 @@ class FileStorageService:
             logger.error(f"创建MinIO bucket失败: {e}")
             raise
     
-    def _calculate_file_hash(self, file_content: bytes) -> str:
-        """计算文件的SHA256哈希值"""
-        return hashlib.sha256(file_content).hexdigest()
+    def warm_up(self):
+        """在后台线程中检查 MinIO bucket，不阻塞应用启动"""
+        if self._bucket_task is None:
+            self._bucket_task = asyncio.create_task(asyncio.to_thread(self._ensure_minio_bucket))
+            # 启动阶段的失败已在 _ensure_minio_bucket 中记录，此处仅取走异常避免告警
+            self._bucket_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    
+    async def ensure_ready(self):
+        """等待 MinIO bucket 就绪；检查通过后直接返回，失败时下次调用重新检查"""
+        if self._bucket_ready:
+            return
+        self.warm_up()
+        task = self._bucket_task
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            if self._bucket_task is task:
+                self._bucket_task = None
+            raise
+        self._bucket_ready = True
+    
+    @staticmethod
+    def _spool_upload(src, tmp_path: Path) -> Tuple[str, int]:
+        """将上传内容分块复制到临时文件并同时计算哈希，整个复制过程在一个线程内完成"""
+        hasher = _new_sha256()
+        file_size = 0
+        src.seek(0)
+        with open(tmp_path, "wb") as dst:
+            while chunk := src.read(UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+                dst.write(chunk)
+                file_size += len(chunk)
+        return hasher.hexdigest(), file_size
     
     async def _upload_to_minio(self, file_path: Path, object_name: str) -> str:
         """
@@ -79,11 +147,14 @@ class FileStorageService:
             
             logger.debug(f"开始上传到MinIO: {object_name}")
             
-            # 上传文件
-            self.minio_client.fput_object(
+            # 上传文件（阻塞的网络传输放到线程中执行，不占用事件循环）
+            await asyncio.to_thread(
+                self.minio_client.fput_object,
                 bucket_name=self.minio_bucket,
                 object_name=object_name,
-                file_path=str(file_path)
+                file_path=str(file_path),
+                part_size=_select_part_size(file_path.stat().st_size),
+                num_parallel_uploads=settings.minio_parallel_uploads
             )
             
             # 构建访问URL
@@ -97,6 +168,18 @@ class FileStorageService:
             logger.error(f"上传到MinIO失败: {e} (文件: {file_path})")
             raise
     
+    async def _upload_once(self, file_path: Path, object_name: str) -> str:
+        """上传文件到MinIO；同一对象已在上传中时等待该次上传的结果"""
+        task = self._inflight_uploads.get(object_name)
+        if task is None:
+            task = asyncio.create_task(self._upload_to_minio(file_path, object_name))
+            self._inflight_uploads[object_name] = task
+            task.add_done_callback(lambda _: self._inflight_uploads.pop(object_name, None))
+        else:
+            logger.info(f"相同文件正在上传到MinIO，等待其完成: {object_name}")
+        # 某个等待方被取消时不影响共享的上传任务
+        return await asyncio.shield(task)
+    
     async def save_file(self, file: UploadFile, doc_type: str = "public") -> Tuple[str, str, int, str, str, str]:
         """
         保存上传的文件到本地和MinIO
@@ -109,16 +192,6 @@ class FileStorageService:
             Tuple: (文件哈希, 本地文件路径, 文件大小, 文件类型, MinIO文件名, MinIO访问URL)
         """
         try:
-            # 读取文件内容
-            logger.debug(f"开始读取文件内容: {file.filename}")
-            file_content = await file.read()
-            file_size = len(file_content)
-            logger.debug(f"文件读取完成: {file.filename}, 大小: {file_size}字节")
-            
-            # 计算文件哈希
-            file_hash = self._calculate_file_hash(file_content)
-            logger.debug(f"文件哈希计算完成: {file.filename} -> {file_hash}")
-            
             # 确定文件类型
             file_extension = Path(file.filename).suffix.lower()
             file_type = file_extension[1:] if file_extension else "unknown"  # 去掉点号
@@ -126,22 +199,32 @@ class FileStorageService:
             # 确定存储目录
             target_dir = self.public_dir if doc_type == "public" else self.personal_dir
             
-            # 构建完整文件路径，直接存放在public或personal文件夹下
-            file_path = target_dir / f"{file_hash}{file_extension}"
-            
-            # 如果文件已存在（相同哈希），则不需要重新保存
-            if not file_path.exists():
-                # 保存文件到本地
-                with open(file_path, "wb") as f:
-                    f.write(file_content)
-                logger.info(f"文件已保存到本地: {file_path} (原文件名: {file.filename}, 类型: {doc_type})")
-            else:
-                logger.info(f"文件已存在，跳过本地保存: {file_path} (原文件名: {file.filename}, 类型: {doc_type})")
+            # 直接从上传的临时文件分块读取，边计算哈希边写入，内存占用与文件大小无关；
+            # 整个复制放在一个线程中执行，避免每个分块都切换一次线程
+            logger.debug(f"开始读取文件内容: {file.filename}")
+            tmp_path = target_dir / f".upload-{uuid.uuid4().hex}.tmp"
+            try:
+                file_hash, file_size = await asyncio.to_thread(self._spool_upload, file.file, tmp_path)
+                logger.debug(f"文件读取完成: {file.filename}, 大小: {file_size}字节, 哈希: {file_hash}")
+                
+                # 构建完整文件路径，直接存放在public或personal文件夹下
+                file_path = target_dir / f"{file_hash}{file_extension}"
+                
+                # 如果文件已存在（相同哈希），则不需要重新保存
+                if not file_path.exists():
+                    # 原子重命名为按哈希命名的文件
+                    os.replace(tmp_path, file_path)
+                    logger.info(f"文件已保存到本地: {file_path} (原文件名: {file.filename}, 类型: {doc_type})")
+                else:
+                    logger.info(f"文件已存在，跳过本地保存: {file_path} (原文件名: {file.filename}, 类型: {doc_type})")
+            finally:
+                tmp_path.unlink(missing_ok=True)
             
             # 上传到MinIO
             minio_object_name = f"{file_hash}{file_extension}"
             minio_filename = f"{file_hash}{file_extension}"
-            minio_url = await self._upload_to_minio(file_path, minio_object_name)
+            await self.ensure_ready()
+            minio_url = await self._upload_once(file_path, minio_object_name)
             
             # 返回相对路径（相对于base_dir）
             relative_path = str(file_path.relative_to(self.base_dir))
@@ -162,7 +245,7 @@ class FileStorageService:
         Returns:
             str: 文件的完整路径
         """
-        return str(self.base_dir / relative_path)
+        return os.path.join(self._base_str, relative_path)
     
     def delete_file(self, relative_path: str) -> bool:
         """
@@ -175,14 +258,13 @@ class FileStorageService:
             bool: 删除是否成功
         """
         try:
-            file_path = self.base_dir / relative_path
-            if file_path.exists():
-                file_path.unlink()
-                logger.info(f"文件已删除: {file_path}")
-                return True
-            else:
-                logger.warning(f"文件不存在，无法删除: {file_path}")
-                return False
+            file_path = os.path.join(self._base_str, relative_path)
+            os.remove(file_path)
+            logger.info(f"文件已删除: {file_path}")
+            return True
+        except FileNotFoundError:
+            logger.warning(f"文件不存在，无法删除: {file_path}")
+            return False
         except Exception as e:
             logger.error(f"删除文件失败: {e}")
             return False
@@ -197,8 +279,7 @@ class FileStorageService:
         Returns:
             bool: 文件是否存在
         """
-        file_path = self.base_dir / relative_path
-        return file_path.exists()
+        return os.access(os.path.join(self._base_str, relative_path), os.F_OK)
 
 
 # 创建全局文件存储服务实例
@@ -0,0 +1,100 @@
+"""
+消息写入器 - 将短时间内的并发消息写入合并为一次批量提交
+"""
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+from app.database import get_db_context
+from app.services.conversation_service import ConversationService
+from app.utils.logger import logger
+
+
+class MessageWriter:
+    """基于 asyncio.Queue 的消息批量写入器，每批最多 max_batch 条；有写入排队时最多再等待 max_delay 秒"""
+
+    def __init__(self, max_batch: int = 64, max_delay: float = 0.02):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # 未启动写入任务时单独写入的任务，保持强引用直到完成
+        self._direct_tasks: set = set()
+
+    def start(self):
+        """在事件循环内启动写入任务"""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+            logger.info("消息写入器已启动")
+
+    async def close(self):
+        """写完队列中剩余的消息后停止写入任务"""
+        if self._worker is None:
+            return
+        self._queue.put_nowait(None)
+        await self._worker
+        self._worker = None
+        self._queue = None
+        logger.info("消息写入器已关闭")
+
+    def submit(self, row: Dict[str, Any]) -> asyncio.Future:
+        """加入写入队列，返回写入完成后得到是否成功的 Future；不关心结果的调用方无需等待"""
+        future = asyncio.get_running_loop().create_future()
+        if self._worker is None or self._worker.done():
+            # 写入任务未运行（如脚本或测试环境）时单独写入
+            task = asyncio.create_task(self._flush([(row, future)]))
+            self._direct_tasks.add(task)
+            task.add_done_callback(self._direct_tasks.discard)
+            return future
+        self._queue.put_nowait((row, future))
+        return future
+
+    async def _run(self):
+        """合并窗口期内到达的消息，按入队顺序批量写入"""
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            stopping = self._drain(batch)
+            if not stopping and 1 < len(batch) < self.max_batch:
+                # 已有其它写入排队时才等待窗口期，让随后到达的写入进入同一批次；单条写入立即提交
+                await asyncio.sleep(self.max_delay)
+                stopping = self._drain(batch)
+
+            await self._flush(batch)
+
+    def _drain(self, batch: List) -> bool:
+        """不等待地取出队列中已有的写入，直到批次已满；遇到停止标记时返回 True"""
+        while len(batch) < self.max_batch and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is None:
+                return True
+            batch.append(item)
+        return False
+
+    async def _flush(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]):
+        """执行批量写入并通知等待方"""
+        rows = [row for row, _ in batch]
+        try:
+            await asyncio.to_thread(self._write, rows)
+            ok = True
+            logger.debug("批量写入消息 {} 条", len(rows))
+        except Exception as e:
+            logger.error("批量写入消息失败，共 {} 条: {}", len(rows), e)
+            ok = False
+
+        for _, future in batch:
+            if not future.done():
+                future.set_result(ok)
+
+    @staticmethod
+    def _write(rows: List[Dict[str, Any]]):
+        """同步数据库写入，在线程中执行"""
+        with get_db_context() as db:
+            ConversationService(db).save_messages(rows)
+
+
+# 全局消息写入器实例
+message_writer = MessageWriter()
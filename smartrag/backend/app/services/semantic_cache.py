@@ -0,0 +1,80 @@
+"""
+语义回复缓存 - 对语义近似的用户问题复用已有回复
+"""
+from typing import Dict, Hashable, List, Optional
+import numpy as np
+
+
+class SemanticResponseCache:
+    """基于向量余弦相似度的进程内回复缓存，超出容量时淘汰最久未命中的条目；只在相同作用域（如模型与系统提示）内复用回复"""
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 10000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._embs: Optional[np.ndarray] = None
+        self._last_used: Optional[np.ndarray] = None
+        self._scope_ids: Optional[np.ndarray] = None
+        self._texts: List[str] = []
+        self._tick = 0
+        # 作用域 -> 整数编号，便于向量化比较
+        self._scopes: Dict[Hashable, int] = {}
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> Optional[np.ndarray]:
+        """转换为单位向量，零向量返回 None"""
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            return None
+        return vec / norm
+
+    def lookup(self, embedding: List[float], scope: Hashable = None) -> Optional[str]:
+        """在同一作用域内查找与给定向量足够相似的缓存回复"""
+        size = len(self._texts)
+        scope_id = self._scopes.get(scope)
+        if not size or scope_id is None:
+            return None
+        vec = self._normalize(embedding)
+        if vec is None or vec.shape[0] != self._embs.shape[1]:
+            return None
+
+        scores = np.where(self._scope_ids[:size] == scope_id, self._embs[:size] @ vec, -np.inf)
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+
+        self._tick += 1
+        self._last_used[best] = self._tick
+        return self._texts[best]
+
+    def add(self, embedding: List[float], text: str, scope: Hashable = None):
+        """写入缓存，超出容量时替换最久未命中的条目"""
+        vec = self._normalize(embedding)
+        if vec is None:
+            return
+
+        self._tick += 1
+        if self._embs is None or vec.shape[0] != self._embs.shape[1]:
+            # 首次写入或向量维度变化（更换了嵌入模型）时重建
+            self._embs = np.empty((min(64, self.max_entries), vec.shape[0]), dtype=np.float32)
+            self._last_used = np.zeros(self._embs.shape[0], dtype=np.int64)
+            self._scope_ids = np.zeros(self._embs.shape[0], dtype=np.int64)
+            self._texts = []
+
+        size = len(self._texts)
+        if size < self.max_entries:
+            if size == self._embs.shape[0]:
+                # 容量按倍数扩展，避免每次写入都复制整个矩阵
+                capacity = min(size * 2, self.max_entries)
+                self._embs = np.resize(self._embs, (capacity, vec.shape[0]))
+                self._last_used = np.resize(self._last_used, capacity)
+                self._scope_ids = np.resize(self._scope_ids, capacity)
+            slot = size
+            self._texts.append(text)
+        else:
+            slot = int(np.argmin(self._last_used))
+            self._texts[slot] = text
+
+        self._embs[slot] = vec
+        self._last_used[slot] = self._tick
+        self._scope_ids[slot] = self._scopes.setdefault(scope, len(self._scopes))
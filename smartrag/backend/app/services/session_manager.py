@@ -1,8 +1,9 @@
 """
 用户会话管理器 - 实现用户隔离的短期记忆存储
 """
-import json
+import re
 import asyncio
+import orjson
 import uuid
 from typing import Dict, List, Optional, Any
 from datetime import datetime, timedelta
@@ -13,9 +14,18 @@ from app.utils.logger import logger
 from app.database import get_db_context
 from app.services.conversation_service import ConversationService
 from app.services.summary_service import summary_service
+from app.services.message_writer import message_writer
 
 
-@dataclass
+# 消息重要性：角色权重与关键词（关键词合并为一个正则，单次扫描即可判断是否命中）
+_ROLE_WEIGHTS = {"system": 1.0, "user": 0.8, "model": 0.6}
+_IMPORTANT_KEYWORDS_RE = re.compile("|".join(map(re.escape, ("重要", "紧急", "关键", "必须", "请", "谢谢"))))
+
+# 会话压缩锁的过期时间（秒），需覆盖一次摘要生成的耗时；持有锁的进程异常退出时锁自动失效
+_COMPACTION_LOCK_TTL = 120
+
+
+@dataclass(slots=True)
 class ChatMessage:
     """聊天消息数据类"""
     role: str
@@ -23,9 +33,26 @@ class ChatMessage:
     timestamp: datetime
     tokens: int = 0
     importance: float = 1.0
+    
+    def pack(self) -> bytes:
+        """序列化为缓存列表中的一个元素（时间存为时间戳）"""
+        return orjson.dumps({
+            "role": self.role,
+            "content": self.content,
+            "timestamp": self.timestamp.timestamp(),
+            "tokens": self.tokens,
+            "importance": self.importance
+        })
+    
+    @classmethod
+    def unpack(cls, raw) -> "ChatMessage":
+        """从缓存列表元素还原消息"""
+        data = orjson.loads(raw)
+        data["timestamp"] = datetime.fromtimestamp(data["timestamp"])
+        return cls(**data)
 
 
-@dataclass
+@dataclass(slots=True)
 class UserSession:
     """用户会话数据类"""
     user_id: int
@@ -36,6 +63,8 @@ class UserSession:
     max_tokens: int = 4000
     max_rounds: int = 10
     summary: Optional[str] = None
+    # 当前消息中的用户消息数（即对话轮数），随消息增删同步维护
+    user_msg_count: int = 0
     
     def get_history(self) -> List[Dict[str, Any]]:
         """获取会话历史记录"""
@@ -49,50 +78,42 @@ class UserSession:
     
     def get_rounds(self) -> int:
         """获取当前对话轮数（一轮包括用户消息和助手回复）"""
-        user_messages = [msg for msg in self.messages if msg.role == "user"]
-        return len(user_messages)
-    
-    def to_dict(self) -> Dict[str, Any]:
-        """转换为字典格式"""
-        messages = []
-        for msg in self.messages:
-            messages.append({
-                "role": msg.role,
-                "content": msg.content,
-                "timestamp": msg.timestamp.isoformat(),
-                "tokens": msg.tokens,
-                "importance": msg.importance
-            })
-        
+        return self.user_msg_count
+    
+    def recount_rounds(self):
+        """消息列表被整体替换后重新统计用户消息数"""
+        self.user_msg_count = sum(1 for msg in self.messages if msg.role == "user")
+    
+    def to_meta_dict(self) -> Dict[str, Any]:
+        """转换为会话元数据字典（不含消息，消息单独存放在缓存列表中）"""
         return {
             "user_id": self.user_id,
             "conversation_id": self.conversation_id,
-            "messages": messages,
             "total_tokens": self.total_tokens,
-            "last_activity": self.last_activity.isoformat(),
+            "last_activity": self.last_activity.timestamp(),
             "max_tokens": self.max_tokens,
             "max_rounds": self.max_rounds,
-            "summary": self.summary
+            "summary": self.summary,
+            "user_msg_count": self.user_msg_count
         }
     
     @classmethod
-    def from_dict(cls, data: Dict[str, Any]) -> "UserSession":
-        """从字典创建实例"""
-        messages = []
-        for msg_data in data.get("messages", []):
-            msg_data["timestamp"] = datetime.fromisoformat(msg_data["timestamp"])
-            messages.append(ChatMessage(**msg_data))
-        
-        return cls(
-            user_id=data["user_id"],
-            conversation_id=data["conversation_id"],
-            messages=messages,
-            total_tokens=data["total_tokens"],
-            last_activity=datetime.fromisoformat(data["last_activity"]),
-            max_tokens=data.get("max_tokens", 4000),
-            max_rounds=data.get("max_rounds", 10),
-            summary=data.get("summary")
+    def from_cache(cls, meta: Dict[str, Any], packed_messages: List) -> "UserSession":
+        """由缓存中的元数据和消息列表创建实例"""
+        session = cls(
+            user_id=meta["user_id"],
+            conversation_id=meta["conversation_id"],
+            messages=[ChatMessage.unpack(raw) for raw in packed_messages],
+            total_tokens=meta["total_tokens"],
+            last_activity=datetime.fromtimestamp(meta["last_activity"]),
+            max_tokens=meta.get("max_tokens", 4000),
+            max_rounds=meta.get("max_rounds", 10),
+            summary=meta.get("summary"),
+            user_msg_count=meta.get("user_msg_count", 0)
         )
+        if "user_msg_count" not in meta:
+            session.recount_rounds()
+        return session
 
 
 class UserSessionManager:
@@ -101,9 +122,13 @@ class UserSessionManager:
     def __init__(self):
         self.redis_client = redis_client
         self.session_ttl = 600
-        self.cleanup_interval = 300
-        self._cleanup_task = None
+        # 会话元数据（存在性与摘要）缓存时间
+        self.meta_ttl = 3600
         self._initialized = False
+        # 超出轮数限制时保留的最近消息数，其余压缩进摘要
+        self.keep_recent_messages = 4
+        # 后台压缩任务的强引用
+        self._compaction_tasks: set = set()
     
     async def initialize(self):
         """初始化会话管理器"""
@@ -114,35 +139,18 @@ class UserSessionManager:
             await self.redis_client.ping()
             logger.info("Redis连接测试成功")
             
-            await self.start_cleanup_task()
-            
+            # 过期会话由 Redis 的 TTL 自动清理，无需后台任务
             self._initialized = True
             logger.info("用户会话管理器初始化完成")
         except Exception as e:
-            logger.error(f"用户会话管理器初始化失败: {e}")
+            logger.error("用户会话管理器初始化失败: {}", e)
             raise
     
     def close(self):
         """关闭会话管理器"""
-        if self._cleanup_task:
-            self._cleanup_task.cancel()
-            self._cleanup_task = None
-            logger.info("用户会话管理器已关闭")
-    
-    async def start_cleanup_task(self):
-        """启动定期清理任务"""
-        if self._cleanup_task is None:
-            self._cleanup_task = asyncio.create_task(self._cleanup_expired_sessions())
-    
-    async def stop_cleanup_task(self):
-        """停止清理任务"""
-        if self._cleanup_task:
-            self._cleanup_task.cancel()
-            try:
-                await self._cleanup_task
-            except asyncio.CancelledError:
-                pass
-            self._cleanup_task = None
+        for task in self._compaction_tasks:
+            task.cancel()
+        logger.info("用户会话管理器已关闭")
     
     async def create_conversation(self, user_id: int, conversation_id: str, title: str = "新对话") -> bool:
         """在数据库中创建新会话"""
@@ -150,45 +158,57 @@ class UserSessionManager:
             with get_db_context() as db:
                 conv_service = ConversationService(db)
                 conv_service.create_conversation(conversation_id, user_id, title)
-                logger.info(f"在数据库中创建会话: {conversation_id}")
+                logger.info("在数据库中创建会话: {}", conversation_id)
                 return True
         except Exception as e:
-            logger.error(f"创建会话失败: {e}")
+            logger.error("创建会话失败: {}", e)
             return False
     
-    async def get_conversation_summary(self, conversation_id: str) -> Optional[str]:
-        """从数据库获取会话摘要"""
+    async def _get_conversation_meta(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """获取会话元数据（摘要），优先读取Redis缓存；会话不存在时返回 None 且不缓存"""
+        meta_key = f"conversation_meta:{conversation_id}"
+        try:
+            cached = await self.redis_client.get(meta_key)
+            if cached:
+                return orjson.loads(cached)
+        except Exception as e:
+            logger.warning("读取会话 {} 元数据缓存失败: {}", conversation_id, e)
+        
         try:
             with get_db_context() as db:
-                conv_service = ConversationService(db)
-                conversation = conv_service.get_conversation(conversation_id)
-                if conversation:
-                    return conversation.summary
-                return None
+                conversation = ConversationService(db).get_conversation(conversation_id)
+                if not conversation:
+                    return None
+                meta = {"summary": conversation.summary}
         except Exception as e:
-            logger.error(f"获取会话摘要失败: {e}")
+            logger.error("获取会话信息失败: {}", e)
             return None
+        
+        await self.redis_client.setex(meta_key, self.meta_ttl, orjson.dumps(meta))
+        return meta
+    
+    async def get_conversation_summary(self, conversation_id: str) -> Optional[str]:
+        """获取会话摘要"""
+        meta = await self._get_conversation_meta(conversation_id)
+        return meta["summary"] if meta else None
     
     async def conversation_exists(self, conversation_id: str) -> bool:
         """检查会话是否存在于数据库中"""
-        try:
-            with get_db_context() as db:
-                conv_service = ConversationService(db)
-                conversation = conv_service.get_conversation(conversation_id)
-                return conversation is not None
-        except Exception as e:
-            logger.error(f"检查会话是否存在失败: {e}")
-            return False
+        return await self._get_conversation_meta(conversation_id) is not None
     
     async def save_conversation_summary(self, conversation_id: str, summary: str) -> bool:
         """保存会话摘要到数据库"""
         try:
             with get_db_context() as db:
                 conv_service = ConversationService(db)
-                return conv_service.update_conversation_summary(conversation_id, summary)
+                saved = conv_service.update_conversation_summary(conversation_id, summary)
         except Exception as e:
-            logger.error(f"保存会话摘要失败: {e}")
+            logger.error("保存会话摘要失败: {}", e)
             return False
+        
+        # 摘要已变化，使元数据缓存失效
+        await self.redis_client.delete(f"conversation_meta:{conversation_id}")
+        return saved
     
     async def get_user_session(self, user_id: int, conversation_id: Optional[str] = None) -> UserSession:
         """获取用户会话"""
@@ -196,61 +216,83 @@ class UserSessionManager:
             logger.error("conversation_id 不能为空")
             raise ValueError("conversation_id 不能为空")
         
-        session_key = f"conversation:{conversation_id}"
+        meta_key, messages_key = self._session_keys(conversation_id)
         
         try:
-            logger.debug(f"从Redis获取会话数据，键: {session_key}")
-            session_data = await self.redis_client.get(session_key)
+            logger.debug("从Redis获取会话数据，键: {}", meta_key)
+            # 元数据与消息列表一次读取，同时刷新过期时间，无需把整个会话重新写回
+            meta_data, packed_messages = await self.redis_client.get_value_and_list(meta_key, messages_key, self.session_ttl)
             
-            if session_data:
-                logger.debug(f"找到会话 {conversation_id} 的缓存数据")
-                session = UserSession.from_dict(json.loads(session_data))
-                logger.info(f"会话 {conversation_id} 缓存: 消息数={len(session.messages)}, 轮数={session.get_rounds()}")
+            if meta_data:
+                logger.debug("找到会话 {} 的缓存数据", conversation_id)
+                session = UserSession.from_cache(orjson.loads(meta_data), packed_messages)
+                logger.opt(lazy=True).info("会话 {} 缓存: 消息数={}, 轮数={}", lambda: conversation_id, lambda: len(session.messages), session.get_rounds)
                 session.last_activity = datetime.now()
-                await self.save_user_session(session)
                 return session
-            else:
-                logger.info(f"会话 {conversation_id} 没有缓存，从数据库加载")
-                
-                # 检查会话是否存在于数据库中
-                if not await self.conversation_exists(conversation_id):
-                    logger.error(f"会话 {conversation_id} 不存在于数据库中")
-                    raise ValueError(f"会话 {conversation_id} 不存在")
-                
-                # 从数据库获取摘要
-                summary = await self.get_conversation_summary(conversation_id)
-                
-                # 返回空消息列表的会话，不创建Redis缓存
-                logger.info(f"从数据库加载会话 {conversation_id}，摘要: {summary}")
-                return UserSession(
-                    user_id=user_id,
-                    conversation_id=conversation_id,
-                    messages=[],
-                    total_tokens=0,
-                    last_activity=datetime.now(),
-                    summary=summary
-                )
+            elif packed_messages:
+                # 元数据已失效但消息列表残留，丢弃后从数据库重建
+                await self.redis_client.delete(messages_key)
+            
+            logger.info("会话 {} 没有缓存，从数据库加载", conversation_id)
+            return await self._load_session_from_db(user_id, conversation_id)
         except Exception as e:
-            logger.error(f"获取用户会话失败: {e}")
+            logger.error("获取用户会话失败: {}", e)
             raise
     
+    async def _load_session_from_db(self, user_id: int, conversation_id: str) -> UserSession:
+        """从数据库加载会话（仅摘要，不创建Redis缓存）"""
+        # 一次查询同时确认会话存在并取得摘要
+        meta = await self._get_conversation_meta(conversation_id)
+        if meta is None:
+            logger.error("会话 {} 不存在于数据库中", conversation_id)
+            raise ValueError(f"会话 {conversation_id} 不存在")
+        summary = meta["summary"]
+        
+        # 返回空消息列表的会话，不创建Redis缓存
+        logger.info("从数据库加载会话 {}，摘要: {}", conversation_id, summary)
+        return UserSession(
+            user_id=user_id,
+            conversation_id=conversation_id,
+            messages=[],
+            total_tokens=0,
+            last_activity=datetime.now(),
+            summary=summary
+        )
+    
+    async def switch_session(self, user_id: int, conversation_id: str) -> UserSession:
+        """丢弃会话的过期缓存并直接从数据库重建，省去一次无用的Redis读取"""
+        await self.clear_session(conversation_id)
+        return await self._load_session_from_db(user_id, conversation_id)
+    
+    @staticmethod
+    def _session_keys(conversation_id: str):
+        """会话在Redis中的键：会话状态（字符串）与消息（列表）"""
+        return f"conversation:{conversation_id}:session", f"conversation:{conversation_id}:messages"
+    
     async def save_user_session(self, session: UserSession):
-        """保存用户会话"""
-        session_key = f"conversation:{session.conversation_id}"
+        """完整保存用户会话（重写整个消息列表）"""
+        await self._store_session(session, [msg.pack() for msg in session.messages], replace=True)
+    
+    async def _store_session(self, session: UserSession, new_messages: List[bytes], replace: bool = False):
+        """写入会话元数据并追加消息，已缓存的消息无需重新序列化"""
+        meta_key, messages_key = self._session_keys(session.conversation_id)
         
         try:
-            session_data = json.dumps(session.to_dict(), ensure_ascii=False)
-            await self.redis_client.setex(
-                session_key, 
-                self.session_ttl, 
-                session_data
+            await self.redis_client.setex_and_extend(
+                meta_key,
+                orjson.dumps(session.to_meta_dict()),
+                messages_key,
+                new_messages,
+                ttl=self.session_ttl,
+                replace=replace
             )
         except Exception as e:
-            logger.error(f"保存用户会话失败: {e}")
+            logger.error("保存用户会话失败: {}", e)
     
     async def add_message(self, user_id: int, conversation_id: str, role: str, content: str, tokens: int = 0) -> UserSession:
         """添加消息到用户会话"""
         try:
+            # 数据库只在缓存未命中和更新标题时用到，各自短暂占用连接，不跨越 await
             session = await self.get_user_session(user_id, conversation_id)
             
             message = ChatMessage(
@@ -261,54 +303,56 @@ class UserSessionManager:
                 importance=self._calculate_importance(role, content)
             )
             
-            logger.info(f"添加消息到会话 {conversation_id}: 角色={role}, 内容前50字符={content[:50]}, Token数={tokens}")
+            logger.info("添加消息到会话 {}: 角色={}, 内容前50字符={}, Token数={}", conversation_id, role, content[:50], tokens)
             
             session.messages.append(message)
+            if role == "user":
+                session.user_msg_count += 1
             session.total_tokens += tokens
             session.last_activity = datetime.now()
             
             # 保存消息到数据库
             message_id = f"msg_{uuid.uuid4().hex[:16]}_{user_id}"
-            await self._save_message_to_db(session.conversation_id, message_id, role, content, tokens)
+            self._save_message_to_db(session.conversation_id, message_id, role, content, tokens)
             
             # 如果是第一条用户消息，更新会话标题
-            if role == "user":
-                user_messages = [msg for msg in session.messages if msg.role == "user"]
-                if len(user_messages) == 1:
-                    await self._update_conversation_title(session.conversation_id, content)
+            if role == "user" and session.user_msg_count == 1:
+                await self._update_conversation_title(session.conversation_id, content)
             
-            # 检查是否超出对话轮数限制
+            # 检查是否超出对话轮数限制，摘要在后台生成，不阻塞当前请求
             if session.get_rounds() > session.max_rounds:
-                await self._handle_round_limit(session)
+                self._schedule_compaction(user_id, session.conversation_id)
             
-            # 保存会话到Redis，每次活动更新过期时间
-            await self.save_user_session(session)
+            # 只追加新消息并更新元数据，每次活动更新过期时间
+            await self._store_session(session, [message.pack()])
             
-            logger.info(f"消息已添加并保存，当前会话消息数: {len(session.messages)}, 对话轮数: {session.get_rounds()}, 总Token数: {session.total_tokens}")
+            logger.opt(lazy=True).info(
+                "消息已添加并保存，当前会话消息数: {}, 对话轮数: {}, 总Token数: {}",
+                lambda: len(session.messages), session.get_rounds, lambda: session.total_tokens
+            )
             return session
         except Exception as e:
-            logger.error(f"添加消息到会话 {conversation_id} 失败: {e}")
+            logger.error("添加消息到会话 {} 失败: {}", conversation_id, e)
             logger.exception(e)
             raise
     
-    async def _save_message_to_db(self, conversation_id: str, message_id: str, role: str, content: str, tokens: int) -> bool:
-        """保存消息到数据库"""
-        try:
-            from app.models.conversation import MessageRole
-            
-            # 转换角色
-            role_map = {"user": MessageRole.user, "model": MessageRole.assistant, "assistant": MessageRole.assistant}
-            message_role = role_map.get(role, MessageRole.user)
-            
-            with get_db_context() as db:
-                conv_service = ConversationService(db)
-                conv_service.save_message(conversation_id, message_id, message_role, content, tokens)
-                logger.debug(f"消息已保存到数据库: {message_id}")
-                return True
-        except Exception as e:
-            logger.error(f"保存消息到数据库失败: {e}")
-            logger.exception(e)
-            return False
+    def _save_message_to_db(self, conversation_id: str, message_id: str, role: str, content: str, tokens: int):
+        """保存消息到数据库（交给消息写入器与并发请求的写入合并提交，不等待写入完成）"""
+        from app.models.conversation import MessageRole
+        
+        # 转换角色
+        role_map = {"user": MessageRole.user, "model": MessageRole.assistant, "assistant": MessageRole.assistant}
+        message_role = role_map.get(role, MessageRole.user)
+        
+        message_writer.submit({
+            "conversation_id": conversation_id,
+            "message_id": message_id,
+            "role": message_role,
+            "content": content,
+            "tokens": tokens,
+            "importance": 1.0,
+            "created_at": datetime.now(),
+        })
     
     async def _update_conversation_title(self, conversation_id: str, first_message: str) -> bool:
         """使用第一条用户消息更新会话标题"""
@@ -322,16 +366,24 @@ class UserSessionManager:
                 conv_service = ConversationService(db)
                 result = conv_service.update_conversation_title(conversation_id, title)
                 if result:
-                    logger.info(f"会话 {conversation_id} 标题已更新为: {title}")
+                    logger.info("会话 {} 标题已更新为: {}", conversation_id, title)
                 return result
         except Exception as e:
-            logger.error(f"更新会话标题失败: {e}")
+            logger.error("更新会话标题失败: {}", e)
             return False
     
     async def get_conversation_context(self, user_id: int, conversation_id: Optional[str] = None) -> List[Dict[str, str]]:
         """获取用于LLM的对话上下文（包含摘要）"""
         session = await self.get_user_session(user_id, conversation_id)
-        
+        return self._build_context(session)
+    
+    async def add_user_message_and_get_context(self, user_id: int, conversation_id: str, message: str) -> List[Dict[str, str]]:
+        """添加用户消息，并直接基于更新后的会话组装LLM上下文（省去一次会话读取）"""
+        session = await self.add_message(user_id, conversation_id, "user", message)
+        return self._build_context(session)
+    
+    def _build_context(self, session: UserSession) -> List[Dict[str, str]]:
+        """根据会话组装上下文：系统消息 + 摘要 + 历史消息"""
         context = []
         
         # 添加系统消息
@@ -367,48 +419,71 @@ class UserSessionManager:
         return history
     
     async def clear_session(self, conversation_id: str):
-        """清除会话缓存"""
-        session_key = f"conversation:{conversation_id}"
+        """清除会话缓存及其元数据缓存"""
+        meta_key, messages_key = self._session_keys(conversation_id)
         
         try:
-            await self.redis_client.delete(session_key)
-            logger.info(f"已清除会话 {conversation_id} 的缓存")
+            await self.redis_client.delete(meta_key)
+            await self.redis_client.delete(messages_key)
+            await self.redis_client.delete(f"conversation_meta:{conversation_id}")
+            logger.info("已清除会话 {} 的缓存", conversation_id)
         except Exception as e:
-            logger.error(f"清除会话 {conversation_id} 缓存失败: {e}")
+            logger.error("清除会话 {} 缓存失败: {}", conversation_id, e)
+    
+    def _schedule_compaction(self, user_id: int, conversation_id: str):
+        """为会话安排一次后台摘要压缩（同一会话同时只压缩一次，由 Redis 锁跨进程保证）"""
+        task = asyncio.create_task(self._summarize_and_compact(user_id, conversation_id))
+        self._compaction_tasks.add(task)
+        task.add_done_callback(self._compaction_tasks.discard)
     
-    async def _handle_round_limit(self, session: UserSession):
-        """处理对话轮数限制，生成摘要并清空Redis"""
+    async def _summarize_and_compact(self, user_id: int, conversation_id: str):
+        """将较早的消息压缩为摘要，仅保留最近的若干条消息"""
+        lock_key = f"conversation:{conversation_id}:compacting"
+        token = await self.redis_client.acquire_lock(lock_key, _COMPACTION_LOCK_TTL)
+        if token is None:
+            # 其它请求或进程正在压缩该会话
+            return
+        
         try:
-            logger.info(f"会话 {session.conversation_id} 达到 {session.max_rounds} 轮对话，开始生成摘要")
+            session = await self.get_user_session(user_id, conversation_id)
+            old_messages = session.messages[:-self.keep_recent_messages]
+            if not old_messages:
+                return
             
-            # 获取当前摘要
-            old_summary = session.summary
+            logger.info("会话 {} 达到 {} 轮对话，开始在后台生成摘要", conversation_id, session.max_rounds)
             
-            # 生成新摘要
-            conversation_history = session.get_history()
-            new_summary = await summary_service.generate_summary(conversation_history, old_summary)
+            # 基于旧摘要和较早的消息生成新摘要
+            conversation_history = [{"role": msg.role, "content": msg.content} for msg in old_messages]
+            new_summary = await summary_service.generate_summary(conversation_history, session.summary)
             
             # 保存摘要到数据库
-            await self.save_conversation_summary(session.conversation_id, new_summary)
+            await self.save_conversation_summary(conversation_id, new_summary)
             
-            # 清空Redis中的消息
-            session.messages = []
-            session.total_tokens = 0
-            session.summary = new_summary
+            # 持有锁期间其它请求只会在列表尾部追加消息，头部的旧消息保持不变；
+            # 移除旧消息并只更新摘要、Token 数和轮数，期间其它请求写入的元数据不会被覆盖
+            meta_key, messages_key = self._session_keys(conversation_id)
+            compacted = await self.redis_client.compact_session(
+                meta_key,
+                messages_key,
+                len(old_messages),
+                new_summary,
+                sum(msg.tokens for msg in old_messages),
+                sum(1 for msg in old_messages if msg.role == "user")
+            )
             
-            logger.info(f"摘要已生成并保存: {new_summary[:100]}...")
-            logger.info(f"Redis中的对话记录已清空")
+            logger.info("摘要已生成并保存: {}...", new_summary[:100])
+            if compacted:
+                logger.info("已压缩 {} 条消息，保留最近的消息", len(old_messages))
             
         except Exception as e:
-            logger.error(f"处理对话轮数限制失败: {e}")
+            logger.error("会话 {} 摘要压缩失败: {}", conversation_id, e)
             logger.exception(e)
+        finally:
+            await self.redis_client.release_lock(lock_key, token)
     
     def _calculate_importance(self, role: str, content: str) -> float:
         """计算消息重要性"""
-        importance = 1.0
-        
-        role_weights = {"system": 1.0, "user": 0.8, "model": 0.6}
-        importance += role_weights.get(role, 0.5)
+        importance = 1.0 + _ROLE_WEIGHTS.get(role, 0.5)
         
         length = len(content)
         if 50 <= length <= 500:
@@ -416,25 +491,10 @@ class UserSessionManager:
         elif length > 500:
             importance += 0.1
         
-        important_keywords = ["重要", "紧急", "关键", "必须", "请", "谢谢"]
-        for keyword in important_keywords:
-            if keyword in content:
-                importance += 0.1
-                break
+        if _IMPORTANT_KEYWORDS_RE.search(content):
+            importance += 0.1
         
         return min(importance, 2.0)
-    
-    async def _cleanup_expired_sessions(self):
-        """定期清理过期会话"""
-        while True:
-            try:
-                await asyncio.sleep(self.cleanup_interval)
-                logger.info("开始清理过期用户会话")
-                
-            except asyncio.CancelledError:
-                break
-            except Exception as e:
-                logger.error(f"清理过期会话时出错: {e}")
 
 
 # 创建全局会话管理器实例
@@ -1,23 +1,78 @@
 """
 摘要生成服务 - 用于生成对话摘要
 """
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Mapping, Optional
+from types import MappingProxyType
+import httpx
 from openai import AsyncOpenAI
 from app.config import settings
 from app.utils.logger import logger
+from app.utils.tokens import estimate_tokens
+
+
+# 对话角色对应的显示名称，其它角色不参与摘要
+_ROLE_LABELS = {"user": "用户", "assistant": "助手", "model": "助手"}
+
+# 提示词模板在导入时拆分为固定片段，调用时只需拼接变量部分
+_SUMMARY_SYSTEM_MSG: Mapping[str, str] = MappingProxyType({
+    "role": "system",
+    "content": "你是一个专业的对话摘要生成助手，擅长提取对话的核心信息和关键内容。"
+})
+_UPDATE_SUMMARY_PROMPT = (
+    "你是一个专业的对话摘要生成助手。请根据以下信息生成一个简洁、准确的对话摘要，重点是不能遗漏关键信息。\n\n【之前的对话摘要】\n",
+    "\n\n【新增的对话内容】\n",
+    "\n\n请基于之前的摘要和新增的对话内容，生成一个更新后的摘要。摘要应该：\n"
+    "1. 保留之前摘要中的关键信息\n"
+    "2. 融合新增对话中的重要内容\n"
+    "3. 简洁明了，不超过200字\n"
+    "4. 突出对话的主题和关键信息\n\n"
+    "请直接输出摘要内容，不要包含其他说明文字。",
+)
+_NEW_SUMMARY_PROMPT = (
+    "你是一个专业的对话摘要生成助手。请根据以下对话内容生成一个简洁、准确的摘要。\n\n【对话内容】\n",
+    "\n\n摘要应该：\n"
+    "1. 简洁明了，不超过200字\n"
+    "2. 突出对话的主题和关键信息\n"
+    "3. 包含用户的主要问题和助手的核心回答\n\n"
+    "请直接输出摘要内容，不要包含其他说明文字。",
+)
+_TITLE_SYSTEM_MSG: Mapping[str, str] = MappingProxyType({
+    "role": "system",
+    "content": "你是一个专业的标题生成助手，擅长根据用户的问题生成简洁、准确的对话标题。"
+})
+_TITLE_PROMPT = (
+    "请根据以下用户的问题，生成一个简洁的对话标题（不超过20个字）。\n\n用户问题: ",
+    "\n\n请直接输出标题，不要包含其他说明文字。",
+)
 
 
 class SummaryService:
     """摘要生成服务"""
     
     def __init__(self):
+        # 长连接 + HTTP/2：后台摘要与标题请求复用同一 TLS 连接，并发请求在连接上多路复用
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=16,
+                max_keepalive_connections=16,
+                keepalive_expiry=60.0
+            ),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            http2=True
+        )
         self.client = AsyncOpenAI(
             api_key=settings.siliconflow_api_key,
-            base_url=settings.siliconflow_base_url
+            base_url=settings.siliconflow_base_url,
+            http_client=self._http
         )
         self.model = settings.siliconflow_model
         logger.info(f"SummaryService 初始化完成，使用模型: {self.model}")
     
+    async def aclose(self):
+        """关闭 HTTP 连接池"""
+        await self._http.aclose()
+        logger.info("SummaryService HTTP 连接池已关闭")
+    
     async def generate_summary(
         self,
         conversation_history: List[Dict[str, str]],
@@ -39,45 +94,14 @@ class SummaryService:
             
             # 构建提示词
             if old_summary:
-                prompt = f"""你是一个专业的对话摘要生成助手。请根据以下信息生成一个简洁、准确的对话摘要，重点是不能遗漏关键信息。
-
-【之前的对话摘要】
-{old_summary}
-
-【新增的对话内容】
-{conversation_text}
-
-请基于之前的摘要和新增的对话内容，生成一个更新后的摘要。摘要应该：
-1. 保留之前摘要中的关键信息
-2. 融合新增对话中的重要内容
-3. 简洁明了，不超过200字
-4. 突出对话的主题和关键信息
-
-请直接输出摘要内容，不要包含其他说明文字。"""
+                prefix, middle, suffix = _UPDATE_SUMMARY_PROMPT
+                prompt = "".join((prefix, old_summary, middle, conversation_text, suffix))
             else:
-                prompt = f"""你是一个专业的对话摘要生成助手。请根据以下对话内容生成一个简洁、准确的摘要。
-
-【对话内容】
-{conversation_text}
-
-摘要应该：
-1. 简洁明了，不超过200字
-2. 突出对话的主题和关键信息
-3. 包含用户的主要问题和助手的核心回答
-
-请直接输出摘要内容，不要包含其他说明文字。"""
+                prefix, suffix = _NEW_SUMMARY_PROMPT
+                prompt = "".join((prefix, conversation_text, suffix))
             
             # 调用 LLM API 生成摘要
-            messages = [
-                {
-                    "role": "system",
-                    "content": "你是一个专业的对话摘要生成助手，擅长提取对话的核心信息和关键内容。"
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
+            messages = [_SUMMARY_SYSTEM_MSG, {"role": "user", "content": prompt}]
             
             logger.info(f"开始生成摘要，对话轮数: {len(conversation_history) // 2}, 是否有旧摘要: {bool(old_summary)}")
             
@@ -110,18 +134,21 @@ class SummaryService:
         Returns:
             str: 格式化后的对话文本
         """
-        formatted_lines = []
+        # 从最新的消息往前取，超出 token 预算时丢弃更早的消息
+        budget = settings.summary_input_token_budget
+        lines = []
+        for msg in reversed(conversation_history):
+            label = _ROLE_LABELS.get(msg.get("role", ""))
+            if label is None:
+                continue
+            line = f"{label}: {msg.get('content', '')}"
+            budget -= estimate_tokens(line)
+            if budget < 0 and lines:
+                logger.info(f"摘要输入超出预算，丢弃最早的 {len(conversation_history) - len(lines)} 条消息")
+                break
+            lines.append(line)
         
-        for msg in conversation_history:
-            role = msg.get("role", "")
-            content = msg.get("content", "")
-            
-            if role == "user":
-                formatted_lines.append(f"用户: {content}")
-            elif role in ["assistant", "model"]:
-                formatted_lines.append(f"助手: {content}")
-        
-        return "\n".join(formatted_lines)
+        return "\n".join(reversed(lines))
     
     async def generate_title(self, first_message: str) -> str:
         """
@@ -134,20 +161,8 @@ class SummaryService:
             str: 生成的标题
         """
         try:
-            messages = [
-                {
-                    "role": "system",
-                    "content": "你是一个专业的标题生成助手，擅长根据用户的问题生成简洁、准确的对话标题。"
-                },
-                {
-                    "role": "user",
-                    "content": f"""请根据以下用户的问题，生成一个简洁的对话标题（不超过20个字）。
-
-用户问题: {first_message}
-
-请直接输出标题，不要包含其他说明文字。"""
-                }
-            ]
+            prefix, suffix = _TITLE_PROMPT
+            messages = [_TITLE_SYSTEM_MSG, {"role": "user", "content": "".join((prefix, str(first_message), suffix))}]
             
             logger.info(f"开始生成标题，用户消息: {first_message[:50]}...")
             
@@ -1,133 +1,26 @@
 import smtplib
+import socket
 import threading
-import queue
 import time
+from collections import deque
 from contextlib import contextmanager
+from functools import lru_cache
 from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from email.header import Header
+from email.charset import Charset, QP
+from email.policy import compat32
+from typing import Deque, Dict, List, Tuple
 from app.utils.logger import logger
 from app.config import settings
 
 
-class EmailService:
-    def __init__(self):
-        self.mail_count = settings.mail_count
-        self.mail_password = settings.mail_password
-        self.mail_server = settings.mail_server
-        self.mail_port = settings.mail_port
-        
-        logger.info(f"邮件服务初始化 - 服务器: {self.mail_server}, 端口: {self.mail_port}, 账号: {self.mail_count}")
-        
-        # 创建邮件连接池
-        self.connection_pool = queue.Queue(maxsize=10)
-        self.pool_lock = threading.Lock()
-        
-        # 邮件发送队列，支持异步发送
-        self.email_queue = queue.Queue()
-        self.worker_thread = None
-        self.stop_worker = False
-        
-        # 启动邮件发送工作线程
-        self._start_worker()
-        
-        logger.info("邮件服务初始化完成，连接池和异步发送已启用")
-    
-    def _start_worker(self):
-        """启动邮件发送工作线程"""
-        if self.worker_thread is None or not self.worker_thread.is_alive():
-            self.stop_worker = False
-            self.worker_thread = threading.Thread(target=self._email_worker, daemon=True)
-            self.worker_thread.start()
-            logger.info("邮件发送工作线程已启动")
-    
-    def _email_worker(self):
-        """邮件发送工作线程"""
-        while not self.stop_worker:
-            try:
-                # 从队列中获取邮件任务，最多等待1秒
-                try:
-                    email_task = self.email_queue.get(timeout=1)
-                    self._send_email_sync(
-                        email_task['to_email'], 
-                        email_task['code'],
-                        email_task.get('code_type', 'registration')
-                    )
-                    self.email_queue.task_done()
-                except queue.Empty:
-                    continue
-            except Exception as e:
-                logger.error(f"邮件发送工作线程错误: {e}")
-    
-    @contextmanager
-    def _get_connection(self):
-        """获取邮件连接"""
-        connection = None
-        try:
-            # 尝试从连接池获取连接
-            try:
-                connection = self.connection_pool.get_nowait()
-                # 检查连接是否仍然有效
-                try:
-                    connection.noop()  # 测试连接
-                except smtplib.SMTPException:
-                    connection = None
-            except queue.Empty:
-                pass
-            
-            # 如果没有可用连接，创建新连接
-            if connection is None:
-                if self.mail_port == 465:  # SSL
-                    connection = smtplib.SMTP_SSL(self.mail_server, self.mail_port)
-                else:  # TLS
-                    connection = smtplib.SMTP(self.mail_server, self.mail_port)
-                    connection.starttls()
-                
-                connection.login(self.mail_count, self.mail_password)
-                logger.debug("创建新的邮件连接")
-            
-            yield connection
-        except Exception as e:
-            logger.error(f"获取邮件连接失败: {e}")
-            raise
-        finally:
-            # 将连接返回连接池
-            if connection:
-                try:
-                    # 如果连接池未满，将连接放回池中
-                    self.connection_pool.put_nowait(connection)
-                except queue.Full:
-                    # 连接池已满，关闭连接
-                    try:
-                        connection.quit()
-                    except:
-                        pass
-    
-    def _send_email_sync(self, to_email: str, code: str, code_type: str = "registration") -> bool:
-        """同步发送邮件"""
-        try:
-            # 根据code_type设置邮件主题和内容
-            if code_type == "password_reset":
-                subject = "SmartRAG 密码重置验证码"
-                greeting = "您好！您正在重置 SmartRAG 账户密码"
-                usage_instruction = "1. 请在密码重置页面输入上述 6 位数字验证码"
-                header_color = "linear-gradient(135deg, #ff6b6b 0%, #ee5a24 100%)"  # 红色渐变
-                code_color = "linear-gradient(135deg, #ff9a9e 0%, #fecfef 100%)"  # 粉色渐变
-            else:  # registration
-                subject = "SmartRAG 注册验证码"
-                greeting = "您好！欢迎使用 SmartRAG 智能系统"
-                usage_instruction = "1. 请在注册页面输入上述 6 位数字验证码"
-                header_color = "linear-gradient(135deg, #667eea 0%, #764ba2 100%)"  # 蓝色渐变
-                code_color = "linear-gradient(135deg, #f093fb 0%, #f5576c 100%)"  # 紫色渐变
-            
-            # 创建邮件对象
-            msg = MIMEMultipart()
-            msg['From'] = Header(f"SmartRAG <{self.mail_count}>", 'utf-8')
-            msg['To'] = Header(to_email, 'utf-8')
-            msg['Subject'] = Header(subject, 'utf-8')
-            
-            # 邮件正文
-            body = f"""
+# 验证码在模板中的占位符，正文采用 quoted-printable 编码，占位符在编码后的邮件中保持原样
+_CODE_PLACEHOLDER = "<<CODE>>"
+
+
+def _render_template(subject: str, greeting: str, usage_instruction: str, header_color: str, code_color: str, code: str) -> str:
+    """渲染验证码邮件正文"""
+    return f"""
             <!DOCTYPE html>
             <html>
             <head>
@@ -271,33 +164,344 @@ class EmailService:
             </body>
             </html>
             """
+
+
+# 按验证码类型预先渲染的 (主题, 正文模板)，发送时只需替换验证码占位符
+_TEMPLATES = {
+    code_type: (subject, _render_template(subject, greeting, usage_instruction, header_color, code_color, _CODE_PLACEHOLDER))
+    for code_type, (subject, greeting, usage_instruction, header_color, code_color) in {
+        "registration": (
+            "SmartRAG 注册验证码",
+            "您好！欢迎使用 SmartRAG 智能系统",
+            "1. 请在注册页面输入上述 6 位数字验证码",
+            "linear-gradient(135deg, #667eea 0%, #764ba2 100%)",  # 蓝色渐变
+            "linear-gradient(135deg, #f093fb 0%, #f5576c 100%)",  # 紫色渐变
+        ),
+        "password_reset": (
+            "SmartRAG 密码重置验证码",
+            "您好！您正在重置 SmartRAG 账户密码",
+            "1. 请在密码重置页面输入上述 6 位数字验证码",
+            "linear-gradient(135deg, #ff6b6b 0%, #ee5a24 100%)",  # 红色渐变
+            "linear-gradient(135deg, #ff9a9e 0%, #fecfef 100%)",  # 粉色渐变
+        ),
+    }.items()
+}
+
+# 连接空闲超过该秒数后，服务器多半已将其断开，不再复用
+_IDLE_MAX_SECONDS = 300
+# 单个连接被取用的次数上限，达到后关闭并重建，避免长期占用同一会话
+_MAX_CONNECTION_USES = 1000
+
+# 关闭服务时放入发送队列的停止标记
+_STOP = None
+
+# 工作线程每次从队列取出、在同一连接上连续发送的最大邮件数
+_BATCH_SIZE = 32
+
+# 正文使用 quoted-printable 编码的 UTF-8 字符集
+_QP_UTF8 = Charset('utf-8')
+_QP_UTF8.body_encoding = QP
+
+
+def _build_message(subject: str, body_template: str) -> Tuple[bytes, bytes]:
+    """用 email 包生成一次完整邮件，并在验证码占位符处切分为 (验证码前部分, 验证码后部分)"""
+    # 只有一个 HTML 正文，直接使用单部分的 text/html 邮件，无需 multipart 外壳和分隔符
+    msg = MIMEText(body_template, 'html', _QP_UTF8)
+    msg['From'] = Header(f"SmartRAG <{settings.mail_count}>", 'utf-8')
+    msg['Subject'] = Header(subject, 'utf-8')
+    # 直接以字节交给 smtplib 时不会再转换换行符，这里按 SMTP 要求使用 CRLF
+    head, tail = msg.as_bytes(policy=compat32.clone(linesep="\r\n")).split(_CODE_PLACEHOLDER.encode('ascii'))
+    return head, tail
+
+
+# 按验证码类型缓存的已编码邮件：发件人、主题、MIME 头和正文只编码一次，发送时只需拼入收件人和验证码
+_MESSAGES = {code_type: _build_message(subject, body_template) for code_type, (subject, body_template) in _TEMPLATES.items()}
+
+
+@lru_cache(maxsize=128)
+def _render_body(code_type: str, code: str) -> bytes:
+    """拼出除 To 头以外的完整邮件，同一验证码发给多个收件人时只拼接一次"""
+    head, tail = _MESSAGES.get(code_type) or _MESSAGES["registration"]
+    return b"".join((head, code.encode('ascii'), tail))
+
+
+@lru_cache(maxsize=1024)
+def _encode_to(addr: str) -> bytes:
+    """编码收件人头部：可打印 ASCII 地址原样使用，其余地址按 RFC 2047 编码"""
+    if addr.isascii() and addr.isprintable():
+        return addr.encode('ascii')
+    return Header(addr, 'utf-8').encode().encode('ascii')
+
+
+class _PipeliningMixin:
+    """服务器支持 PIPELINING 扩展时，将 MAIL FROM、RCPT TO、DATA 合并为一次往返发送"""
+    
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        if mail_options or rcpt_options or not self.has_extn('pipelining'):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+        
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        if isinstance(msg, str):
+            msg = smtplib._fix_eols(msg).encode('ascii')
+        
+        # 一次写出全部命令，再按顺序读取各自的回复
+        commands = [f"MAIL FROM:{smtplib.quoteaddr(from_addr)}"]
+        commands.extend(f"RCPT TO:{smtplib.quoteaddr(addr)}" for addr in to_addrs)
+        commands.append("DATA")
+        self.send("".join(f"{command}\r\n" for command in commands))
+        (mail_code, mail_resp), *rcpt_replies, (data_code, data_resp) = [self.getreply() for _ in commands]
+        
+        senderrs = {addr: reply for addr, reply in zip(to_addrs, rcpt_replies) if reply[0] not in (250, 251)}
+        if mail_code != 250 or len(senderrs) == len(to_addrs) or data_code != 354:
+            if data_code == 354:
+                # 服务器已进入数据阶段，先发送空正文结束本次事务
+                self.send(b".\r\n")
+                self.getreply()
+            self._rset()
+            if mail_code != 250:
+                raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+            if len(senderrs) == len(to_addrs):
+                raise smtplib.SMTPRecipientsRefused(senderrs)
+            raise smtplib.SMTPDataError(data_code, data_resp)
+        
+        # 发送正文，与 SMTP.data 的处理一致
+        q = smtplib._quote_periods(msg)
+        if q[-2:] != smtplib.bCRLF:
+            q = q + smtplib.bCRLF
+        self.send(q + b"." + smtplib.bCRLF)
+        code, resp = self.getreply()
+        if code != 250:
+            self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return senderrs
+
+
+class PipelinedSMTP(_PipeliningMixin, smtplib.SMTP):
+    """支持命令流水线的 SMTP 连接"""
+
+
+class PipelinedSMTP_SSL(_PipeliningMixin, smtplib.SMTP_SSL):
+    """支持命令流水线的 SMTP over SSL 连接"""
+
+
+class _LocalConnection:
+    """线程独占的邮件连接，发送中途断开时可原地替换为新连接"""
+    __slots__ = ("smtp", "uses", "last_used")
+    
+    def __init__(self, smtp: smtplib.SMTP):
+        self.smtp = smtp
+        self.uses = 0
+        self.last_used = time.monotonic()
+
+
+class MailQueueFullError(Exception):
+    """邮件发送队列已满，调用方应稍后重试"""
+
+
+class EmailService:
+    def __init__(self):
+        self.mail_count = settings.mail_count
+        self.mail_password = settings.mail_password
+        self.mail_server = settings.mail_server
+        self.mail_port = settings.mail_port
+        
+        logger.info("邮件服务初始化 - 服务器: {}, 端口: {}, 账号: {}", self.mail_server, self.mail_port, self.mail_count)
+        
+        # 每个线程独占一个邮件连接，发送时无需在线程间借还；另外记录全部连接以便关闭服务时统一断开
+        self._local = threading.local()
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        
+        # 邮件发送队列，支持异步发送
+        # deque 的 append/popleft 是线程安全的，配合 Event 唤醒工作线程，入队无需加锁
+        self.email_queue: Deque[Dict[str, str]] = deque()
+        self._wake = threading.Event()
+        self.worker_threads: List[threading.Thread] = []
+        
+        # 启动邮件发送工作线程
+        self._start_workers()
+        
+        logger.info("邮件服务初始化完成，线程独占连接和异步发送已启用")
+    
+    def _start_workers(self):
+        """启动邮件发送工作线程，多个线程各自持有连接并行发送"""
+        self.worker_threads = [thread for thread in self.worker_threads if thread.is_alive()]
+        if self.worker_threads:
+            return
+        # 清除上次关闭时留下的停止标记
+        if self.email_queue and self.email_queue[0] is _STOP:
+            self.email_queue.popleft()
+        for i in range(max(1, settings.mail_workers)):
+            # 前 settings.mail_prewarm 个线程启动后先建立连接，避免首批邮件承担 TLS 握手和登录的耗时
+            thread = threading.Thread(target=self._email_worker, args=(i < settings.mail_prewarm,), name=f"email-worker-{i}", daemon=True)
+            thread.start()
+            self.worker_threads.append(thread)
+        logger.info("邮件发送工作线程已启动: {} 个", len(self.worker_threads))
+    
+    def _email_worker(self, prewarm: bool = False):
+        """邮件发送工作线程，取到停止标记时发送完手上的任务后退出"""
+        if prewarm:
+            try:
+                self._acquire_connection()
+            except Exception as e:
+                logger.warning("预建邮件连接失败: {}", e)
+        
+        stopping = False
+        while not stopping:
+            try:
+                # 队列为空时等待新任务，空闲期间不会被唤醒
+                if not self.email_queue:
+                    self._wake.wait()
+                    self._wake.clear()
+                
+                # 取出已在排队的任务，在同一个连接上发送
+                batch = []
+                while len(batch) < _BATCH_SIZE:
+                    try:
+                        email_task = self.email_queue.popleft()
+                    except IndexError:
+                        break
+                    if email_task is _STOP:
+                        # 把停止标记放回队首，让其它工作线程也能取到
+                        self.email_queue.appendleft(_STOP)
+                        self._wake.set()
+                        stopping = True
+                        break
+                    batch.append(email_task)
+                
+                if batch:
+                    self._send_batch(batch)
+            except Exception as e:
+                logger.error("邮件发送工作线程错误: {}", e)
+    
+    def _send_batch(self, batch: List[Dict[str, str]]):
+        """在同一个连接上依次发送一批邮件，单封邮件被拒不影响其余邮件"""
+        sent = 0
+        try:
+            with self._get_connection() as local:
+                for email_task in batch:
+                    to_email = email_task['to_email']
+                    try:
+                        self._send_message(local, to_email, email_task['code'], email_task.get('code_type', 'registration'))
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as e:
+                        logger.error("邮件发送失败: {}***, {}", to_email[:3], e)
+                    else:
+                        logger.info("验证码邮件发送成功: {}***", to_email[:3])
+                    sent += 1
+        except Exception as e:
+            logger.error("邮件批量发送中断，未发送 {} 封: {}", len(batch) - sent, e)
+    
+    def _connect(self) -> smtplib.SMTP:
+        """创建并登录一个新的邮件连接"""
+        if self.mail_port == 465:  # SSL
+            connection = PipelinedSMTP_SSL(self.mail_server, self.mail_port)
+        else:  # TLS
+            connection = PipelinedSMTP(self.mail_server, self.mail_port)
+        # 关闭 Nagle 算法，避免短小的 SMTP 命令包被内核延迟合并
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.mail_port != 465:
+            connection.starttls()
+        
+        connection.login(self.mail_count, self.mail_password)
+        logger.opt(lazy=True).debug("创建新的邮件连接: {}:{}", lambda: self.mail_server, lambda: self.mail_port)
+        return connection
+    
+    @staticmethod
+    def _close_connection(connection: smtplib.SMTP):
+        """关闭邮件连接，忽略关闭过程中的错误"""
+        try:
+            connection.quit()
+        except Exception:
+            pass
+    
+    def _acquire_connection(self) -> _LocalConnection:
+        """取得当前线程的连接，没有连接或连接空闲过久、使用次数达到上限时重新建立"""
+        local = getattr(self._local, 'connection', None)
+        if local is not None:
+            if time.monotonic() - local.last_used <= _IDLE_MAX_SECONDS and local.uses < _MAX_CONNECTION_USES:
+                return local
+            self._discard_connection(local)
+        
+        local = _LocalConnection(self._connect())
+        self._local.connection = local
+        with self._connections_lock:
+            self._connections.add(local)
+        return local
+    
+    def _discard_connection(self, local: _LocalConnection):
+        """关闭当前线程的连接并不再使用"""
+        if getattr(self._local, 'connection', None) is local:
+            self._local.connection = None
+        with self._connections_lock:
+            self._connections.discard(local)
+        self._close_connection(local.smtp)
+    
+    @contextmanager
+    def _get_connection(self):
+        """获取当前线程的邮件连接，不做存活检查，由发送失败时的重连处理失效连接"""
+        local = None
+        try:
+            local = self._acquire_connection()
+            yield local
+            local.uses += 1
+            local.last_used = time.monotonic()
+        except Exception as e:
+            # 已断开的连接不再复用，下次使用时重新建立
+            if local is not None and isinstance(e, (smtplib.SMTPServerDisconnected, OSError)):
+                self._discard_connection(local)
+            logger.error("获取邮件连接失败: {}", e)
+            raise
+    
+    def _send_message(self, local: _LocalConnection, to_email: str, code: str, code_type: str):
+        """在当前线程的连接上发送一封验证码邮件，连接已断开时重连并重试一次"""
+        # 除收件人外的邮件内容只与类型和验证码有关，按二者缓存
+        message = b"".join((b"To: ", _encode_to(to_email), b"\r\n", _render_body(code_type, code)))
+        
+        for attempt in (0, 1):
+            try:
+                local.smtp.sendmail(self.mail_count, [to_email], message)
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                if attempt:
+                    raise
+                logger.info("邮件连接已断开，重新连接后重试: {}", e)
+                local.smtp.close()
+                local.smtp = self._connect()
+                local.uses = 0
+    
+    def _send_email_sync(self, to_email: str, code: str, code_type: str = "registration") -> bool:
+        """同步发送邮件"""
+        try:
+            # 使用当前线程的连接发送邮件
+            with self._get_connection() as local:
+                self._send_message(local, to_email, code, code_type)
             
-            msg.attach(MIMEText(body, 'html', 'utf-8'))
-            
-            # 使用连接池发送邮件
-            with self._get_connection() as server:
-                server.sendmail(self.mail_count, [to_email], msg.as_string())
-            
-            logger.info(f"验证码邮件发送成功: {to_email[:3]}***")
+            logger.info("验证码邮件发送成功: {}***", to_email[:3])
             return True
         except Exception as e:
-            logger.error(f"邮件发送失败: {e}")
+            logger.error("邮件发送失败: {}", e)
             return False
     
     def send_verification_code(self, to_email: str, code: str, code_type: str = "registration", async_send: bool = True) -> bool:
-        """发送验证码邮件"""
+        """发送验证码邮件，异步发送且队列已满时抛出 MailQueueFullError"""
         if async_send:
-            # 异步发送：将邮件任务放入队列
+            # 异步发送：将邮件任务放入队列，队列已满时直接拒绝，避免突发请求使内存无限增长
+            if len(self.email_queue) >= settings.mail_queue_max:
+                logger.warning("邮件发送队列已满({})，拒绝发送: {}***", settings.mail_queue_max, to_email[:3])
+                raise MailQueueFullError()
             try:
-                self.email_queue.put({
+                self.email_queue.append({
                     'to_email': to_email,
                     'code': code,
                     'code_type': code_type
                 })
-                logger.info(f"验证码邮件已加入发送队列: {to_email[:3]}***, 类型: {code_type}")
+                self._wake.set()
+                logger.info("验证码邮件已加入发送队列: {}***, 类型: {}", to_email[:3], code_type)
                 return True
             except Exception as e:
-                logger.error(f"邮件加入队列失败: {e}")
+                logger.error("邮件加入队列失败: {}", e)
                 return False
         else:
             # 同步发送
@@ -306,22 +510,20 @@ class EmailService:
     def shutdown(self):
         """关闭邮件服务"""
         logger.info("正在关闭邮件服务...")
-        self.stop_worker = True
+        # 停止标记排在已入队的邮件之后，工作线程发送完队列中的邮件后退出
+        self.email_queue.append(_STOP)
+        self._wake.set()
         
-        # 等待工作线程结束
-        if self.worker_thread and self.worker_thread.is_alive():
-            self.worker_thread.join(timeout=5)
+        # 等待工作线程结束，所有线程共用 5 秒的等待时间
+        deadline = time.monotonic() + 5
+        for thread in self.worker_threads:
+            thread.join(timeout=max(0, deadline - time.monotonic()))
         
-        # 关闭连接池中的所有连接
-        while not self.connection_pool.empty():
-            try:
-                connection = self.connection_pool.get_nowait()
-                try:
-                    connection.quit()
-                except:
-                    pass
-            except queue.Empty:
-                break
+        # 关闭所有线程的连接
+        with self._connections_lock:
+            connections, self._connections = self._connections, set()
+        for local in connections:
+            self._close_connection(local.smtp)
         
         logger.info("邮件服务已关闭")
 
@@ -50,21 +50,29 @@ def setup_logging():
         rotation="10 MB",
         retention="30 days",
         compression="zip",
-        encoding="utf-8"
+        encoding="utf-8",
+        enqueue=True  # 由后台线程写文件、轮转和压缩，调用方只需入队
     )
     
     # 拦截标准库的logging并重定向到loguru
     class InterceptHandler(logging.Handler):
+        _LOGGING_FILE = logging.__file__
+        # 标准库级别到 loguru 级别名的映射，其它数值级别直接按数值记录
+        _LEVEL_MAP = {
+            logging.DEBUG: "DEBUG",
+            logging.INFO: "INFO",
+            logging.WARNING: "WARNING",
+            logging.ERROR: "ERROR",
+            logging.CRITICAL: "CRITICAL",
+        }
+        
         def emit(self, record):
             # 获取对应的loguru级别
-            try:
-                level = logger.level(record.levelname).name
-            except ValueError:
-                level = record.levelno
+            level = self._LEVEL_MAP.get(record.levelno, record.levelno)
 
-            # 找到调用栈的源头
-            frame, depth = logging.currentframe(), 2
-            while frame.f_code.co_filename == logging.__file__:
+            # 找到调用栈的源头：从 emit 的调用方的上一层开始跳过 logging 模块内部的帧
+            frame, depth = sys._getframe(2), 2
+            while frame and frame.f_code.co_filename == self._LOGGING_FILE:
                 frame = frame.f_back
                 depth += 1
 
@@ -4,41 +4,143 @@ Redis客户端，支持连接池和多用户场景
 """
 import redis
 import redis.connection
-from typing import Optional, Dict, Any
+import redis.asyncio as aioredis
+from typing import Optional, Dict, Any, List, Sequence, Tuple
 from app.config import settings
 from app.utils.logger import logger
 import threading
 import time
-from datetime import datetime, timedelta
-import json
+import heapq
+from collections import OrderedDict
+import orjson
+import uuid
+
+
+# 验证码锁的分片数（2 的幂）
+_LOCK_SHARDS = 256
+
+# 遍历验证码键时每批处理的数量
+_SCAN_BATCH = 500
+
+# 内存缓存最多保存的条目数，Redis 长时间不可用时防止内存无限增长
+_MEMORY_CACHE_MAX = 100000
+
+# Redis 健康检查间隔（秒）
+_HEALTH_CHECK_INTERVAL = 30
+
+# 各类型验证码键的前缀，拼接邮箱即为完整键名
+_KEY_PFX = {
+    "registration": "verification_code:registration:",
+    "password_reset": "verification_code:password_reset:",
+}
+
+
+def _code_key(email: str, code_type: str) -> str:
+    """生成验证码的键名"""
+    prefix = _KEY_PFX.get(code_type)
+    if prefix is None:
+        prefix = f"verification_code:{code_type}:"
+    return prefix + email
+
+
+def _mask_email(email: str) -> str:
+    """日志中隐藏邮箱，只保留首字符和域名，如 a***@example.com"""
+    name, sep, domain = email.partition("@")
+    return f"{name[:1]}***{sep}{domain}"
+
+
+# 验证码最多尝试次数
+_MAX_CODE_ATTEMPTS = 5
+
+# 验证码校验结果
+_CODE_NOT_FOUND, _CODE_VALID, _CODE_INVALID, _CODE_EXHAUSTED = range(4)
+
+# 原子校验验证码的 Lua 脚本，返回 {校验结果, 尝试次数}：
+# 验证码以 JSON 字符串存储，验证码错误时累加尝试次数并保留原过期时间写回，尝试次数已达上限时删除验证码
+_VERIFY_CODE_LUA = """
+local raw = redis.call('GET', KEYS[1])
+if not raw then
+    return {0, 0}
+end
+local data = cjson.decode(raw)
+local attempts = tonumber(data.attempts) or 0
+if attempts >= tonumber(ARGV[2]) then
+    redis.call('DEL', KEYS[1])
+    return {3, attempts}
+end
+if tostring(data.code) ~= ARGV[1] then
+    data.attempts = attempts + 1
+    redis.call('SET', KEYS[1], cjson.encode(data), 'KEEPTTL')
+    return {2, attempts + 1}
+end
+return {1, attempts}
+"""
+
+# 压缩会话的 Lua 脚本：写入新摘要、扣减被移除消息的 Token 数和轮数（保留原过期时间），并移除消息列表头部已压缩的消息；
+# 只改动这几个字段，压缩期间其它请求写入的元数据不会被覆盖。元数据已过期时不做任何修改并返回 0
+_COMPACT_SESSION_LUA = """
+local raw = redis.call('GET', KEYS[1])
+if not raw then
+    return 0
+end
+local meta = cjson.decode(raw)
+meta.summary = ARGV[2]
+meta.total_tokens = math.max(0, (tonumber(meta.total_tokens) or 0) - tonumber(ARGV[3]))
+if meta.user_msg_count ~= nil then
+    meta.user_msg_count = math.max(0, tonumber(meta.user_msg_count) - tonumber(ARGV[4]))
+end
+redis.call('SET', KEYS[1], cjson.encode(meta), 'KEEPTTL')
+redis.call('LTRIM', KEYS[2], tonumber(ARGV[1]), -1)
+return 1
+"""
+
+# 释放锁的 Lua 脚本，只删除仍由自己持有的锁
+_RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
 
 class RedisClient:
     def __init__(self):
         self.use_redis = False
-        self.memory_cache = {}
-        self.memory_cache_expiry = {}
+        # key -> (值, 过期时间)，一次 pop 即可同时移除值和过期时间；按最近访问排序，超出容量时淘汰最久未访问的项
+        self.memory_cache: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        # (过期时间, key) 最小堆，清理时只需检查堆顶
+        self._expiry_heap: List[Tuple[float, str]] = []
+        # 内存缓存与过期堆由请求线程和健康检查线程共同访问，读写都在该锁内进行
+        self._memory_lock = threading.Lock()
         self.pool = None
         self.redis_client = None
+        self.async_client = None
+        self._verify_script = None
+        self._compact_script = None
+        self._release_lock_script = None
         
-        # 线程锁，用于防止验证码冲突
-        self._locks: Dict[str, threading.Lock] = {}
-        self._lock_lock = threading.Lock()
+        # 线程锁，用于防止内存缓存中的验证码冲突；按 key 的哈希分片到固定数量的锁上，内存占用不随用户数增长
+        self._lock_shards: List[threading.Lock] = [threading.Lock() for _ in range(_LOCK_SHARDS)]
         
         # 延迟初始化Redis连接
         self._init_redis()
+        
+        # 后台定期检查Redis状态，断开时切换到内存缓存，恢复后切回Redis
+        self._closed = threading.Event()
+        self._health_thread = threading.Thread(target=self._health_check_loop, daemon=True)
+        self._health_thread.start()
     
     def _init_redis(self):
         """延迟初始化Redis连接"""
         try:
-            # 创建连接池
+            # 创建连接池；同步客户端返回原始字节，验证码的 JSON 记录直接交给 orjson 解析
             self.pool = redis.ConnectionPool(
                 host=settings.redis_host,
                 port=settings.redis_port,
                 password=settings.redis_password,
                 db=settings.redis_db,
-                decode_responses=True,
-                max_connections=50,  # 最大连接数
+                decode_responses=False,
+                max_connections=settings.redis_pool_size,  # 最大连接数
                 socket_timeout=5,  # socket超时时间
                 socket_connect_timeout=5,  # 连接超时时间
                 retry_on_timeout=True,  # 超时重试
@@ -50,302 +152,356 @@ class RedisClient:
             
             # 测试连接
             self.redis_client.ping()
+            self._prewarm_pool()
+            # 注册验证码校验脚本，调用时使用 EVALSHA，脚本未缓存时自动重新加载
+            self._verify_script = self.redis_client.register_script(_VERIFY_CODE_LUA)
+            
+            # 异步方法使用 redis.asyncio 客户端，在事件循环中等待网络 I/O 而不阻塞；连接在首次使用时建立
+            self.async_client = aioredis.Redis(
+                connection_pool=aioredis.ConnectionPool(
+                    host=settings.redis_host,
+                    port=settings.redis_port,
+                    password=settings.redis_password,
+                    db=settings.redis_db,
+                    decode_responses=True,
+                    max_connections=settings.redis_pool_size,
+                    socket_timeout=5,
+                    socket_connect_timeout=5,
+                    retry_on_timeout=True,
+                    health_check_interval=30,
+                )
+            )
+            self._compact_script = self.async_client.register_script(_COMPACT_SESSION_LUA)
+            self._release_lock_script = self.async_client.register_script(_RELEASE_LOCK_LUA)
             self.use_redis = True
             logger.info("Redis连接成功")
         except Exception as e:
-            logger.warning(f"Redis连接失败，使用内存缓存: {e}")
+            logger.warning("Redis连接失败，使用内存缓存: {}", e)
             self.use_redis = False
             self.pool = None
             self.redis_client = None
+            self.async_client = None
+            self._verify_script = None
+            self._compact_script = None
+            self._release_lock_script = None
+    
+    def _prewarm_pool(self):
+        """预先建立少量空闲连接，避免空闲后的首个请求承担 TCP 和认证握手的开销"""
+        connections = []
+        try:
+            for _ in range(max(2, settings.redis_pool_size // 10)):
+                # 取出的连接已完成握手，同时占用多个才能建立不同的连接
+                connections.append(self.pool.get_connection("PING"))
+        except Exception as e:
+            logger.warning("Redis连接池预热失败: {}", e)
+        finally:
+            for connection in connections:
+                self.pool.release(connection)
+    
+    def _health_check_loop(self):
+        """定期 ping Redis，根据结果切换 Redis 与内存缓存"""
+        while not self._closed.wait(_HEALTH_CHECK_INTERVAL):
+            if self.redis_client is None:
+                # 启动时未连上Redis，重新初始化连接
+                self._init_redis()
+                continue
+            try:
+                self.redis_client.ping()
+                if not self.use_redis:
+                    self.use_redis = True
+                    logger.info("Redis连接已恢复，切回Redis")
+            except Exception as e:
+                if self.use_redis:
+                    self.use_redis = False
+                    logger.warning("Redis健康检查失败，切换到内存缓存: {}", e)
     
     def _get_lock(self, key: str) -> threading.Lock:
-        """获取指定key的锁"""
-        with self._lock_lock:
-            if key not in self._locks:
-                self._locks[key] = threading.Lock()
-            return self._locks[key]
+        """获取指定key所在分片的锁"""
+        return self._lock_shards[hash(key) & (_LOCK_SHARDS - 1)]
+    
+    def _memory_put(self, key: str, value, deadline: float):
+        """写入内存缓存项并登记到过期堆，调用方需持有 _memory_lock"""
+        self.memory_cache[key] = (value, deadline)
+        self.memory_cache.move_to_end(key)
+        heapq.heappush(self._expiry_heap, (deadline, key))
+    
+    def memory_set(self, key: str, value, deadline: float):
+        """写入内存缓存项及其过期时间，并登记到过期堆"""
+        with self._memory_lock:
+            self._memory_put(key, value, deadline)
+    
+    def memory_get(self, key: str, default=None):
+        """读取内存缓存项的值，并标记为最近访问"""
+        with self._memory_lock:
+            entry = self.memory_cache.get(key)
+            if entry is None:
+                return default
+            self.memory_cache.move_to_end(key)
+            return entry[0]
+    
+    def memory_delete(self, key: str):
+        """删除内存缓存项，其在过期堆中的记录到期时直接丢弃"""
+        with self._memory_lock:
+            self.memory_cache.pop(key, None)
     
     def _cleanup_expired_memory_cache(self):
-        """清理过期的内存缓存"""
+        """清理过期的内存缓存，只弹出堆顶已到期的项"""
         current_time = time.time()
-        expired_keys = [k for k, v in self.memory_cache_expiry.items() if v < current_time]
-        for key in expired_keys:
-            if key in self.memory_cache:
-                del self.memory_cache[key]
-            del self.memory_cache_expiry[key]
+        heap = self._expiry_heap
+        with self._memory_lock:
+            while heap and heap[0][0] < current_time:
+                deadline, key = heapq.heappop(heap)
+                # 过期时间已被更新或已删除的项在堆中留下的旧记录直接丢弃
+                entry = self.memory_cache.get(key)
+                if entry is not None and entry[1] == deadline:
+                    del self.memory_cache[key]
+            
+            # 超出容量时淘汰最久未访问的项，其在过期堆中的记录到期时直接丢弃
+            while len(self.memory_cache) > _MEMORY_CACHE_MAX:
+                self.memory_cache.popitem(last=False)
     
     def set_verification_code(self, email: str, code: str, code_type: str = "registration") -> bool:
         """存储验证码，5分钟过期，支持多用户场景和验证码类型区分"""
         try:
-            # 使用邮箱作为锁，防止同一邮箱的并发操作
-            lock = self._get_lock(f"vc_lock:{email}:{code_type}")
-            with lock:
-                key = f"verification_code:{code_type}:{email}"
+            # 使用验证码键所在分片的锁，防止同一邮箱的并发操作
+            key = _code_key(email, code_type)
+            with self._get_lock(key):
                 # 存储验证码和创建时间
                 data = {
                     "code": code,
-                    "created_at": datetime.now().isoformat(),
+                    "created_at": int(time.time()),  # 创建时间（Unix 秒）
                     "attempts": 0,  # 尝试次数
                     "type": code_type  # 验证码类型
                 }
                 
                 if self.use_redis and self.redis_client:
                     try:
-                        # 使用hmset替代hset mapping，确保兼容性
-                        logger.info(f"存储验证码到Redis - key: {key}, data: {data}")
-                        for field, value in data.items():
-                            self.redis_client.hset(key, field, value)
-                        self.redis_client.expire(key, settings.verification_code_expire_minutes * 60)
-                        # 验证存储是否成功
-                        stored_data = self.redis_client.hgetall(key)
-                        logger.info(f"验证存储结果 - key: {key}, 存储的数据: {stored_data}")
+                        # 整条记录序列化为 JSON，一条 SET EX 同时写入并设置过期时间
+                        self.redis_client.set(key, orjson.dumps(data), ex=settings.verification_code_expire_minutes * 60)
+                        logger.opt(lazy=True).debug("存储验证码到Redis - 邮箱: {}, 类型: {}", lambda: _mask_email(email), lambda: code_type)
                     except Exception as redis_error:
-                        logger.error(f"Redis存储验证码失败，使用内存缓存: {redis_error}")
+                        logger.error("Redis存储验证码失败，使用内存缓存: {}", redis_error)
                         # Redis失败时使用内存缓存
-                        self.memory_cache[key] = data
-                        self.memory_cache_expiry[key] = time.time() + (settings.verification_code_expire_minutes * 60)
+                        self.memory_set(key, data, time.time() + (settings.verification_code_expire_minutes * 60))
                         self._cleanup_expired_memory_cache()
                 else:
                     # 使用内存缓存
-                    self.memory_cache[key] = data
-                    self.memory_cache_expiry[key] = time.time() + (settings.verification_code_expire_minutes * 60)
+                    self.memory_set(key, data, time.time() + (settings.verification_code_expire_minutes * 60))
                     self._cleanup_expired_memory_cache()
                 
-                logger.info(f"验证码已存储: {email[:3]}***")
+                logger.opt(lazy=True).debug("验证码已存储: {}", lambda: _mask_email(email))
                 return True
         except Exception as e:
-            logger.error(f"存储验证码错误: {e}")
+            logger.error("存储验证码错误: {}", e)
+            return False
+    
+    def set_verification_codes(self, items: Sequence[Tuple[str, str, str]]) -> bool:
+        """批量存储验证码，items 为 (邮箱, 验证码, 验证码类型) 序列；Redis 写入经管道一次往返完成"""
+        try:
+            ttl = settings.verification_code_expire_minutes * 60
+            created_at = int(time.time())
+            records = [
+                (_code_key(email, code_type), {
+                    "code": code,
+                    "created_at": created_at,
+                    "attempts": 0,
+                    "type": code_type
+                })
+                for email, code, code_type in items
+            ]
+            
+            if self.use_redis and self.redis_client:
+                try:
+                    pipe = self.redis_client.pipeline(transaction=False)
+                    for key, data in records:
+                        pipe.set(key, orjson.dumps(data), ex=ttl)
+                    pipe.execute()
+                    logger.debug("批量存储验证码: {} 个", len(records))
+                    return True
+                except Exception as redis_error:
+                    logger.error("Redis批量存储验证码失败，使用内存缓存: {}", redis_error)
+            
+            # 使用内存缓存
+            deadline = time.time() + ttl
+            for key, data in records:
+                self.memory_set(key, data, deadline)
+            self._cleanup_expired_memory_cache()
+            logger.debug("批量存储验证码: {} 个", len(records))
+            return True
+        except Exception as e:
+            logger.error("批量存储验证码错误: {}", e)
             return False
     
     def get_verification_code_data(self, email: str, code_type: str = "registration") -> Optional[Dict[str, Any]]:
         """获取验证码完整数据"""
         try:
-            key = f"verification_code:{code_type}:{email}"
+            key = _code_key(email, code_type)
             
             if self.use_redis and self.redis_client:
                 try:
-                    data = self.redis_client.hgetall(key)
-                    if data:
-                        return data
+                    raw = self.redis_client.get(key)
+                    if raw is not None:
+                        return orjson.loads(raw)
                 except Exception as redis_error:
-                    logger.error(f"Redis获取验证码数据失败: {redis_error}")
+                    logger.error("Redis获取验证码数据失败: {}", redis_error)
                     # Redis失败时尝试使用内存缓存
-                    if key in self.memory_cache:
-                        return self.memory_cache[key]
+                    return self.memory_get(key)
             else:
                 # 使用内存缓存
                 self._cleanup_expired_memory_cache()
-                if key in self.memory_cache:
-                    return self.memory_cache[key]
+                return self.memory_get(key)
             
             return None
         except Exception as e:
-            logger.error(f"获取验证码数据错误: {e}")
+            logger.error("获取验证码数据错误: {}", e)
             return None
     
     def get_verification_code(self, email: str, code_type: str = "registration") -> Optional[str]:
         """获取验证码"""
         try:
-            key = f"verification_code:{code_type}:{email}"
+            key = _code_key(email, code_type)
             
             if self.use_redis and self.redis_client:
                 try:
-                    data = self.redis_client.hgetall(key)
-                    if data and "code" in data:
-                        return data["code"]
+                    raw = self.redis_client.get(key)
+                    if raw is not None:
+                        return orjson.loads(raw)["code"]
                 except Exception as redis_error:
-                    logger.error(f"Redis获取验证码失败: {redis_error}")
+                    logger.error("Redis获取验证码失败: {}", redis_error)
                     # Redis失败时尝试使用内存缓存
-                    if key in self.memory_cache and "code" in self.memory_cache[key]:
-                        return self.memory_cache[key]["code"]
+                    return self.memory_get(key, {}).get("code")
             else:
                 # 使用内存缓存
                 self._cleanup_expired_memory_cache()
-                if key in self.memory_cache and "code" in self.memory_cache[key]:
-                    return self.memory_cache[key]["code"]
+                return self.memory_get(key, {}).get("code")
             
             return None
         except Exception as e:
-            logger.error(f"获取验证码错误: {e}")
+            logger.error("获取验证码错误: {}", e)
             return None
     
     def delete_verification_code(self, email: str, code_type: str = "registration") -> bool:
         """删除验证码"""
         try:
-            key = f"verification_code:{code_type}:{email}"
+            key = _code_key(email, code_type)
             
             if self.use_redis and self.redis_client:
                 try:
                     self.redis_client.delete(key)
                 except Exception as redis_error:
-                    logger.error(f"Redis删除验证码失败: {redis_error}")
+                    logger.error("Redis删除验证码失败: {}", redis_error)
                     # Redis失败时尝试删除内存缓存
-                    if key in self.memory_cache:
-                        del self.memory_cache[key]
-                    if key in self.memory_cache_expiry:
-                        del self.memory_cache_expiry[key]
+                    self.memory_delete(key)
             else:
                 # 使用内存缓存
-                if key in self.memory_cache:
-                    del self.memory_cache[key]
-                if key in self.memory_cache_expiry:
-                    del self.memory_cache_expiry[key]
+                self.memory_delete(key)
             
-            logger.info(f"验证码已删除: {email[:3]}***")
+            logger.opt(lazy=True).debug("验证码已删除: {}", lambda: _mask_email(email))
             return True
         except Exception as e:
-            logger.error(f"删除验证码错误: {e}")
+            logger.error("删除验证码错误: {}", e)
             return False
     
+    def _check_verification_code(self, email: str, code: str, code_type: str) -> Tuple[int, int]:
+        """校验验证码，返回 (校验结果, 尝试次数)；验证码错误时累加尝试次数，尝试次数过多时删除验证码"""
+        key = _code_key(email, code_type)
+        
+        if self.use_redis and self._verify_script is not None:
+            try:
+                # 读取、比较和更新在 Redis 端由脚本一次原子完成，多进程并发校验也无需加锁
+                status, attempts = self._verify_script(keys=[key], args=[code, _MAX_CODE_ATTEMPTS])
+                return int(status), int(attempts)
+            except Exception as redis_error:
+                logger.error("Redis校验验证码失败: {}", redis_error)
+        
+        # 使用内存缓存，加锁保证读取和更新尝试次数的原子性
+        with self._get_lock(key):
+            self._cleanup_expired_memory_cache()
+            data = self.memory_get(key)
+            if not data:
+                return _CODE_NOT_FOUND, 0
+            
+            attempts = int(data.get("attempts", 0))
+            if attempts >= _MAX_CODE_ATTEMPTS:
+                self.memory_delete(key)
+                return _CODE_EXHAUSTED, attempts
+            
+            if data.get("code") != code:
+                data["attempts"] = attempts + 1
+                return _CODE_INVALID, attempts + 1
+            
+            return _CODE_VALID, attempts
+    
     def is_verification_code_valid(self, email: str, code: str, code_type: str = "registration") -> bool:
         """验证验证码是否正确，支持尝试次数限制"""
         try:
-            logger.info(f"开始验证验证码 - 邮箱: {email[:3]}***, 验证码: {code}, 类型: {code_type}, 使用Redis: {self.use_redis}")
-            lock = self._get_lock(f"vc_lock:{email}:{code_type}")
-            with lock:
-                key = f"verification_code:{code_type}:{email}"
-                data = None
-                
-                # 直接获取数据，避免递归调用
-                if self.use_redis and self.redis_client:
-                    try:
-                        logger.info(f"从Redis读取验证码 - key: {key}")
-                        data = self.redis_client.hgetall(key)
-                        logger.info(f"从Redis获取验证码数据 - 邮箱: {email}, key: {key}, 数据: {data}")
-                    except Exception as redis_error:
-                        logger.error(f"Redis获取验证码数据失败: {redis_error}")
-                        # 尝试使用内存缓存
-                        if key in self.memory_cache:
-                            data = self.memory_cache[key]
-                            logger.info(f"从内存缓存获取验证码数据 - 邮箱: {email}, 数据: {data}")
-                else:
-                    # 使用内存缓存
-                    self._cleanup_expired_memory_cache()
-                    if key in self.memory_cache:
-                        data = self.memory_cache[key]
-                        logger.info(f"从内存缓存获取验证码数据 - 邮箱: {email}, 数据: {data}")
-                
-                if not data:
-                    logger.warning(f"验证码数据不存在: {email}")
-                    return False
-                
-                stored_code = data.get("code")
-                logger.info(f"验证码验证 - 邮箱: {email}, 存储的验证码: {stored_code}, 输入的验证码: {code}")
-                attempts = int(data.get("attempts", 0))
-                
-                # 检查尝试次数，防止暴力破解
-                if attempts >= 5:  # 最多尝试5次
-                    logger.warning(f"验证码尝试次数过多: {email}")
-                    self.delete_verification_code(email)
-                    return False
-                
-                # 验证码错误，增加尝试次数
-                if stored_code != code:
-                    if self.use_redis and self.redis_client:
-                        try:
-                            self.redis_client.hincrby(key, "attempts", 1)
-                        except Exception as redis_error:
-                            logger.error(f"Redis更新尝试次数失败: {redis_error}")
-                            # 更新内存缓存
-                            if key in self.memory_cache:
-                                self.memory_cache[key]["attempts"] = attempts + 1
-                    else:
-                        self.memory_cache[key]["attempts"] = attempts + 1
-                    
-                    logger.warning(f"验证码错误: {email}, 尝试次数: {attempts + 1}")
-                    return False
-                
-                # 验证码正确
-                logger.info(f"验证码验证成功: {email}")
-                return True
+            logger.opt(lazy=True).debug("开始验证验证码 - 邮箱: {}, 类型: {}, 使用Redis: {}", lambda: _mask_email(email), lambda: code_type, lambda: self.use_redis)
+            status, attempts = self._check_verification_code(email, code, code_type)
+            
+            if status == _CODE_NOT_FOUND:
+                logger.warning("验证码数据不存在: {}", _mask_email(email))
+                return False
+            
+            # 检查尝试次数，防止暴力破解
+            if status == _CODE_EXHAUSTED:
+                logger.warning("验证码尝试次数过多: {}", _mask_email(email))
+                return False
+            
+            if status == _CODE_INVALID:
+                logger.warning("验证码错误: {}, 尝试次数: {}", _mask_email(email), attempts)
+                return False
+            
+            # 验证码正确
+            logger.opt(lazy=True).debug("验证码验证成功: {}", lambda: _mask_email(email))
+            return True
         except Exception as e:
-            logger.error(f"验证验证码错误: {e}")
+            logger.error("验证验证码错误: {}", e)
             return False
     
     def verify_code_with_details(self, email: str, code: str, code_type: str) -> dict:
         """验证验证码并返回详细信息，包括剩余尝试次数"""
         try:
-            logger.info(f"开始验证验证码（详细信息） - 邮箱: {email[:3]}***, 验证码: {code}, 类型: {code_type}, 使用Redis: {self.use_redis}")
-            lock = self._get_lock(f"vc_lock:{email}:{code_type}")
-            with lock:
-                key = f"verification_code:{code_type}:{email}"
-                data = None
-                
-                # 直接获取数据，避免递归调用
-                if self.use_redis and self.redis_client:
-                    try:
-                        data = self.redis_client.hgetall(key)
-                        logger.info(f"从Redis获取验证码数据 - 邮箱: {email}, 数据: {data}")
-                    except Exception as redis_error:
-                        logger.error(f"Redis获取验证码数据失败: {redis_error}")
-                        # 尝试使用内存缓存
-                        if key in self.memory_cache:
-                            data = self.memory_cache[key]
-                            logger.info(f"从内存缓存获取验证码数据 - 邮箱: {email}, 数据: {data}")
-                else:
-                    # 使用内存缓存
-                    self._cleanup_expired_memory_cache()
-                    if key in self.memory_cache:
-                        data = self.memory_cache[key]
-                        logger.info(f"从内存缓存获取验证码数据 - 邮箱: {email}, 数据: {data}")
-                
-                if not data:
-                    logger.warning(f"验证码数据不存在: {email}")
-                    return {
-                        "valid": False,
-                        "error_type": "code_not_found",
-                        "message": "验证码不存在或已过期",
-                        "remaining_attempts": 0
-                    }
-                
-                stored_code = data.get("code")
-                logger.info(f"验证码验证 - 邮箱: {email}, 存储的验证码: {stored_code}, 输入的验证码: {code}")
-                attempts = int(data.get("attempts", 0))
-                
-                # 检查尝试次数，防止暴力破解
-                if attempts >= 5:  # 最多尝试5次
-                    logger.warning(f"验证码尝试次数过多: {email}")
-                    self.delete_verification_code(email)
-                    return {
-                        "valid": False,
-                        "error_type": "max_attempts_exceeded",
-                        "message": "验证码尝试次数过多，请重新获取验证码",
-                        "remaining_attempts": 0
-                    }
-                
-                # 验证码错误，增加尝试次数
-                if stored_code != code:
-                    new_attempts = attempts + 1
-                    if self.use_redis and self.redis_client:
-                        try:
-                            self.redis_client.hincrby(key, "attempts", 1)
-                        except Exception as redis_error:
-                            logger.error(f"Redis更新尝试次数失败: {redis_error}")
-                            # 更新内存缓存
-                            if key in self.memory_cache:
-                                self.memory_cache[key]["attempts"] = new_attempts
-                    else:
-                        self.memory_cache[key]["attempts"] = new_attempts
-                    
-                    remaining_attempts = 5 - new_attempts
-                    logger.warning(f"验证码错误: {email}, 尝试次数: {new_attempts}, 剩余尝试次数: {remaining_attempts}")
-                    
-                    return {
-                        "valid": False,
-                        "error_type": "invalid_code",
-                        "message": f"验证码错误，剩余尝试次数：{remaining_attempts}",
-                        "remaining_attempts": remaining_attempts
-                    }
-                
-                # 验证码正确
-                logger.info(f"验证码验证成功: {email}")
+            logger.opt(lazy=True).debug("开始验证验证码（详细信息） - 邮箱: {}, 类型: {}, 使用Redis: {}", lambda: _mask_email(email), lambda: code_type, lambda: self.use_redis)
+            status, attempts = self._check_verification_code(email, code, code_type)
+            
+            if status == _CODE_NOT_FOUND:
+                logger.warning("验证码数据不存在: {}", _mask_email(email))
+                return {
+                    "valid": False,
+                    "error_type": "code_not_found",
+                    "message": "验证码不存在或已过期",
+                    "remaining_attempts": 0
+                }
+            
+            # 检查尝试次数，防止暴力破解
+            if status == _CODE_EXHAUSTED:
+                logger.warning("验证码尝试次数过多: {}", _mask_email(email))
                 return {
-                    "valid": True,
-                    "message": "验证码正确",
-                    "remaining_attempts": 5 - attempts
+                    "valid": False,
+                    "error_type": "max_attempts_exceeded",
+                    "message": "验证码尝试次数过多，请重新获取验证码",
+                    "remaining_attempts": 0
                 }
+            
+            remaining_attempts = _MAX_CODE_ATTEMPTS - attempts
+            if status == _CODE_INVALID:
+                logger.warning("验证码错误: {}, 尝试次数: {}, 剩余尝试次数: {}", _mask_email(email), attempts, remaining_attempts)
+                return {
+                    "valid": False,
+                    "error_type": "invalid_code",
+                    "message": f"验证码错误，剩余尝试次数：{remaining_attempts}",
+                    "remaining_attempts": remaining_attempts
+                }
+            
+            # 验证码正确
+            logger.opt(lazy=True).debug("验证码验证成功: {}", lambda: _mask_email(email))
+            return {
+                "valid": True,
+                "message": "验证码正确",
+                "remaining_attempts": remaining_attempts
+            }
         except Exception as e:
-            logger.error(f"验证验证码错误: {e}")
+            logger.error("验证验证码错误: {}", e)
             return {
                 "valid": False,
                 "error_type": "server_error",
@@ -361,78 +517,219 @@ class RedisClient:
                 self._cleanup_expired_memory_cache()
                 return
                 
-            pattern = "verification_code:*"
-            keys = self.redis_client.keys(pattern)
-            current_time = datetime.now()
-            
+            # SCAN 分批遍历，不会像 KEYS 一样长时间阻塞 Redis；每批的 TTL 查询和删除各经管道一次往返完成
+            batch = []
+            for key in self.redis_client.scan_iter(match="verification_code:*", count=_SCAN_BATCH):
+                batch.append(key)
+                if len(batch) >= _SCAN_BATCH:
+                    self._delete_expiring_codes(batch)
+                    batch = []
+            if batch:
+                self._delete_expiring_codes(batch)
+        except Exception as e:
+            logger.error("清理过期验证码错误: {}", e)
+    
+    def _delete_expiring_codes(self, keys: List[bytes]):
+        """删除一批验证码中即将过期的项（剩余时间不足1分钟）"""
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
             for key in keys:
-                # 检查键是否即将过期（提前1分钟清理）
-                try:
-                    ttl = self.redis_client.ttl(key)
-                    if ttl < 60 and ttl > 0:  # 剩余时间小于1分钟
-                        email = key.replace("verification_code:", "")
-                        logger.info(f"清理过期验证码: {email}")
-                        self.redis_client.delete(key)
-                except Exception as e:
-                    logger.error(f"清理单个验证码失败: {key}, 错误: {e}")
-                    continue
+                pipe.ttl(key)
+            expiring = [key for key, ttl in zip(keys, pipe.execute()) if 0 < ttl < 60]
+            if expiring:
+                logger.info("清理即将过期的验证码: {} 个", len(expiring))
+                self.redis_client.delete(*expiring)
         except Exception as e:
-            logger.error(f"清理过期验证码错误: {e}")
+            logger.error("清理验证码失败: {} 个, 错误: {}", len(keys), e)
     
     def close(self):
         """关闭Redis连接"""
+        self._closed.set()
         try:
             if self.redis_client and self.pool:
                 self.redis_client.close()
                 self.pool.disconnect()
                 logger.info("Redis连接已关闭")
         except Exception as e:
-            logger.error(f"关闭Redis连接错误: {e}")
+            logger.error("关闭Redis连接错误: {}", e)
+    
+    async def aclose(self):
+        """关闭异步客户端的连接池，需在事件循环内调用"""
+        try:
+            if self.async_client:
+                await self.async_client.connection_pool.disconnect()
+                logger.info("Redis异步连接池已关闭")
+        except Exception as e:
+            logger.error("关闭Redis异步连接池错误: {}", e)
     
     async def ping(self):
         """测试Redis连接"""
         try:
-            if self.use_redis and self.redis_client:
-                return self.redis_client.ping()
+            if self.use_redis and self.async_client:
+                return await self.async_client.ping()
             return False
         except Exception as e:
-            logger.error(f"Redis ping测试失败: {e}")
+            logger.error("Redis ping测试失败: {}", e)
             return False
     
     async def get(self, key: str):
         """获取Redis键值"""
         try:
-            if self.use_redis and self.redis_client:
-                return self.redis_client.get(key)
+            if self.use_redis and self.async_client:
+                return await self.async_client.get(key)
             # 使用内存缓存作为备选
             self._cleanup_expired_memory_cache()
-            if key in self.memory_cache:
-                return json.dumps(self.memory_cache[key])
+            value = self.memory_get(key)
+            if value is not None:
+                return orjson.dumps(value)
             return None
         except Exception as e:
-            logger.error(f"Redis获取键值失败: {e}")
+            logger.error("Redis获取键值失败: {}", e)
             # 尝试使用内存缓存
             self._cleanup_expired_memory_cache()
-            if key in self.memory_cache:
-                return json.dumps(self.memory_cache[key])
+            value = self.memory_get(key)
+            if value is not None:
+                return orjson.dumps(value)
+            return None
+    
+    async def get_value_and_list(self, value_key: str, list_key: str, ttl: int) -> Tuple[Optional[str], List[str]]:
+        """读取一个字符串键和一个列表键并刷新两者的过期时间，经管道一次往返完成"""
+        try:
+            if self.use_redis and self.async_client:
+                pipe = self.async_client.pipeline(transaction=False)
+                pipe.get(value_key)
+                pipe.lrange(list_key, 0, -1)
+                pipe.expire(value_key, ttl)
+                pipe.expire(list_key, ttl)
+                value, items, _, _ = await pipe.execute()
+                return value, items
+        except Exception as e:
+            logger.error("Redis获取键值失败: {}", e)
+        # 使用内存缓存作为备选
+        self._cleanup_expired_memory_cache()
+        expiry = time.time() + ttl
+        values = []
+        with self._memory_lock:
+            for key in (value_key, list_key):
+                entry = self.memory_cache.get(key)
+                values.append(entry[0] if entry is not None else None)
+                if entry is not None:
+                    self._memory_put(key, entry[0], expiry)
+        return values[0], list(values[1] or ())
+    
+    async def setex_and_extend(
+        self,
+        value_key: str,
+        value,
+        list_key: str,
+        items: Sequence = (),
+        ttl: int = 600,
+        replace: bool = False
+    ) -> bool:
+        """写入字符串键，并对列表键追加元素（replace 时先清空），统一刷新过期时间"""
+        try:
+            if self.use_redis and self.async_client:
+                pipe = self.async_client.pipeline(transaction=False)
+                pipe.setex(value_key, ttl, value)
+                if replace:
+                    pipe.delete(list_key)
+                if items:
+                    pipe.rpush(list_key, *items)
+                pipe.expire(list_key, ttl)
+                await pipe.execute()
+                return True
+        except Exception as e:
+            logger.error("Redis设置键值失败: {}", e)
+        # 使用内存缓存作为备选
+        current = [] if replace else list(self.memory_get(list_key, ()))
+        current.extend(items)
+        expiry = time.time() + ttl
+        self.memory_set(value_key, value, expiry)
+        self.memory_set(list_key, current, expiry)
+        self._cleanup_expired_memory_cache()
+        return True
+    
+    async def compact_session(
+        self,
+        meta_key: str,
+        list_key: str,
+        count: int,
+        summary: str,
+        removed_tokens: int,
+        removed_rounds: int
+    ) -> bool:
+        """原子地移除消息列表头部 count 条消息，并只更新会话元数据中的摘要、Token 数和轮数"""
+        try:
+            if self.use_redis and self._compact_script is not None:
+                return bool(await self._compact_script(
+                    keys=[meta_key, list_key],
+                    args=[count, summary, removed_tokens, removed_rounds]
+                ))
+        except Exception as e:
+            logger.error("Redis压缩会话失败: {}", e)
+            return False
+        # 使用内存缓存作为备选，元数据与消息列表在同一次加锁内更新
+        self._cleanup_expired_memory_cache()
+        with self._memory_lock:
+            meta_entry = self.memory_cache.get(meta_key)
+            if meta_entry is None:
+                return False
+            meta = orjson.loads(meta_entry[0])
+            meta["summary"] = summary
+            meta["total_tokens"] = max(0, meta.get("total_tokens", 0) - removed_tokens)
+            if "user_msg_count" in meta:
+                meta["user_msg_count"] = max(0, meta["user_msg_count"] - removed_rounds)
+            self._memory_put(meta_key, orjson.dumps(meta), meta_entry[1])
+            list_entry = self.memory_cache.get(list_key)
+            if list_entry is not None:
+                self._memory_put(list_key, list_entry[0][count:], list_entry[1])
+        return True
+    
+    async def acquire_lock(self, key: str, ttl: int) -> Optional[str]:
+        """尝试获取锁（SET NX EX），成功时返回释放锁所需的令牌，锁已被占用时返回 None"""
+        token = uuid.uuid4().hex
+        try:
+            if self.use_redis and self.async_client:
+                return token if await self.async_client.set(key, token, nx=True, ex=ttl) else None
+        except Exception as e:
+            logger.error("Redis获取锁失败: {}", e)
             return None
+        # 使用内存缓存作为备选，锁只在当前进程内有效
+        self._cleanup_expired_memory_cache()
+        with self._memory_lock:
+            if key in self.memory_cache:
+                return None
+            self._memory_put(key, token, time.time() + ttl)
+        return token
+    
+    async def release_lock(self, key: str, token: str):
+        """释放由 acquire_lock 获取的锁"""
+        try:
+            if self.use_redis and self._release_lock_script is not None:
+                await self._release_lock_script(keys=[key], args=[token])
+                return
+        except Exception as e:
+            logger.error("Redis释放锁失败: {}", e)
+            return
+        with self._memory_lock:
+            entry = self.memory_cache.get(key)
+            if entry is not None and entry[0] == token:
+                del self.memory_cache[key]
     
     async def setex(self, key: str, ttl: int, value: str):
         """设置Redis键值并指定过期时间"""
         try:
-            if self.use_redis and self.redis_client:
-                return self.redis_client.setex(key, ttl, value)
+            if self.use_redis and self.async_client:
+                return await self.async_client.setex(key, ttl, value)
             # 使用内存缓存作为备选
-            self.memory_cache[key] = json.loads(value)
-            self.memory_cache_expiry[key] = time.time() + ttl
+            self.memory_set(key, orjson.loads(value), time.time() + ttl)
             self._cleanup_expired_memory_cache()
             return True
         except Exception as e:
-            logger.error(f"Redis设置键值失败: {e}")
+            logger.error("Redis设置键值失败: {}", e)
             # 尝试使用内存缓存
             try:
-                self.memory_cache[key] = json.loads(value)
-                self.memory_cache_expiry[key] = time.time() + ttl
+                self.memory_set(key, orjson.loads(value), time.time() + ttl)
                 self._cleanup_expired_memory_cache()
                 return True
             except:
@@ -441,21 +738,15 @@ class RedisClient:
     async def delete(self, key: str):
         """删除Redis键"""
         try:
-            if self.use_redis and self.redis_client:
-                return self.redis_client.delete(key)
+            if self.use_redis and self.async_client:
+                return await self.async_client.delete(key)
             # 使用内存缓存作为备选
-            if key in self.memory_cache:
-                del self.memory_cache[key]
-            if key in self.memory_cache_expiry:
-                del self.memory_cache_expiry[key]
+            self.memory_delete(key)
             return True
         except Exception as e:
-            logger.error(f"Redis删除键失败: {e}")
+            logger.error("Redis删除键失败: {}", e)
             # 尝试使用内存缓存
-            if key in self.memory_cache:
-                del self.memory_cache[key]
-            if key in self.memory_cache_expiry:
-                del self.memory_cache_expiry[key]
+            self.memory_delete(key)
             return True
 
 
@@ -1,6 +1,6 @@
 from datetime import datetime, timedelta
 from typing import Optional
-from jose import JWTError, jwt
+import jwt
 import hashlib
 import secrets
 import base64
@@ -12,19 +12,22 @@ def generate_salt() -> str:
     return base64.b64encode(secrets.token_bytes(16)).decode('utf-8')
 
 
+def _pbkdf2(password: str, salt: str) -> bytes:
+    """使用PBKDF2计算密码摘要"""
+    salted_password = (password + salt).encode('utf-8')
+    return hashlib.pbkdf2_hmac('sha256', salted_password, salt.encode('utf-8'), 100000)
+
+
 def hash_password(password: str, salt: Optional[str] = None) -> str:
     """使用SHA-256和盐值哈希密码"""
     if salt is None:
         salt = generate_salt()
     
-    # 使用PBKDF2进行密码哈希，增加安全性
-    salted_password = (password + salt).encode('utf-8')
-    hash_obj = hashlib.pbkdf2_hmac('sha256', salted_password, salt.encode('utf-8'), 100000)
-    # 将bytes转换为hex字符串
-    hash_hex = hash_obj.hex()
+    # 使用PBKDF2进行密码哈希，增加安全性；摘要以base64存储
+    hash_b64 = base64.b64encode(_pbkdf2(password, salt)).decode('ascii')
     
     # 返回盐值和哈希的组合
-    return f"{salt}:{hash_hex}"
+    return f"{salt}:{hash_b64}"
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -32,10 +35,13 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     try:
         # 从存储的哈希中提取盐值和哈希
         salt, stored_hash = hashed_password.split(':')
-        # 使用相同的盐值计算输入密码的哈希
-        computed_hash = hash_password(plain_password, salt).split(':')[1]
-        # 比较哈希值
-        return secrets.compare_digest(computed_hash, stored_hash)
+        # 旧数据的摘要为64位hex字符串，新数据为base64，统一还原为原始字节
+        if len(stored_hash) == 64:
+            stored_digest = bytes.fromhex(stored_hash)
+        else:
+            stored_digest = base64.b64decode(stored_hash)
+        # 使用相同的盐值计算输入密码的摘要，直接比较原始字节
+        return secrets.compare_digest(_pbkdf2(plain_password, salt), stored_digest)
     except Exception:
         # 如果格式不正确或其他错误，返回False
         return False
@@ -71,7 +77,12 @@ def create_refresh_token(data: dict) -> str:
 def verify_token(token: str) -> Optional[dict]:
     """验证令牌"""
     try:
-        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
+        payload = jwt.decode(
+            token,
+            settings.secret_key,
+            algorithms=[settings.algorithm],
+            options={"require": ["exp"]}
+        )
         return payload
-    except JWTError:
+    except jwt.PyJWTError:
         return None
\ No newline at end of file
@@ -0,0 +1,8 @@
+"""
+Token 估算工具
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中文约每字 1 个 token（UTF-8 三字节），英文约每 3-4 字节 1 个 token"""
+    return len(text.encode("utf-8")) // 3 + 1
@@ -13,10 +13,45 @@ from app.routers import auth, users, chat, documents, conversations
 from app.utils.redis_client import redis_client
 from app.utils.email_service import email_service
 from app.services.session_manager import user_session_manager
+from app.services.message_writer import message_writer
+from app.services.chat_service import create_chat_service, close_chat_service
+from app.services.summary_service import summary_service
+from app.services.file_storage import file_storage_service
+from app.schemas.auth import UserResponse, Token
+from app.schemas.role import RoleResponse
+from app.schemas.chat import ChatResponse
+from app.schemas.document import (
+    PublicDocumentResponse, PersonalDocumentResponse, DocumentUploadResponse,
+    DocumentListResponse, DocumentDetailResponse, FolderUploadResponse
+)
+from app.schemas.conversation import (
+    ConversationResponse, ConversationListResponse, ConversationDetailResponse,
+    ConversationMessageResponse, ConversationMessageListResponse
+)
 
 # 初始化日志系统
 setup_logging()
 
+# 需要在启动时预热的响应模型
+WARMUP_MODELS = (
+    UserResponse, Token, RoleResponse, ChatResponse,
+    PublicDocumentResponse, PersonalDocumentResponse, DocumentUploadResponse,
+    DocumentListResponse, DocumentDetailResponse, FolderUploadResponse,
+    ConversationResponse, ConversationListResponse, ConversationDetailResponse,
+    ConversationMessageResponse, ConversationMessageListResponse,
+)
+
+
+def warmup_schemas():
+    """解析响应模型的前向引用并预先生成 JSON Schema，避免首个文档请求承担生成开销（校验器和序列化器在类定义时已构建，这里不涉及）"""
+    for model in WARMUP_MODELS:
+        try:
+            model.model_rebuild()
+            model.model_json_schema()
+            logger.debug(f"响应模型已预热: {model.__name__}")
+        except Exception as e:
+            logger.warning(f"响应模型预热失败: {model.__name__}, 错误: {e}")
+
 
 def cleanup_resources():
     """清理资源，防止内存泄漏"""
@@ -42,10 +77,23 @@ async def lifespan(app: FastAPI):
     # 启动时执行
     logger.info("SmartRAG Backend 正在启动...")
     
+    # 预热响应模型
+    warmup_schemas()
+    logger.info(f"已预热 {len(WARMUP_MODELS)} 个响应模型")
+    
+    # 启动消息批量写入器
+    message_writer.start()
+    
+    # 后台检查MinIO bucket，不阻塞启动
+    file_storage_service.warm_up()
+    
     # 初始化会话管理器
     await user_session_manager.initialize()
     logger.info("会话管理器初始化完成")
     
+    # 在事件循环内创建聊天服务，使其连接池绑定到当前循环
+    create_chat_service()
+    
     yield
     
     # 关闭时执行
@@ -55,6 +103,18 @@ async def lifespan(app: FastAPI):
     user_session_manager.close()
     logger.info("会话管理器已关闭")
     
+    # 关闭聊天服务的连接池
+    await close_chat_service()
+    
+    # 写完队列中剩余的消息
+    await message_writer.close()
+    
+    # 关闭摘要服务的连接池
+    await summary_service.aclose()
+    
+    # 关闭Redis异步连接池
+    await redis_client.aclose()
+    
     cleanup_resources()
 
 